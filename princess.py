@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 
+import array
 import hub
+import math
 import sys
 import time
 
-import color, motor, motor_pair, runloop
+import color, color_sensor, motor, motor_pair, runloop
 from hub import light_matrix, button, motion_sensor, light, port
 
 
@@ -12,6 +14,214 @@ from hub import light_matrix, button, motion_sensor, light, port
 #----------------------------------------
 
 WHEEL_CIRCUMFERENCE = 17.584
+# distance between the drive wheels' contact points in cm, for arcs.
+# Placeholder, not measured: run calibrate_track_width (slot 7) and copy
+# its value here before using ARC steps
+TRACK_WIDTH = 11.2
+# calibrate_track_width spins TRACK_CALIBRATION_TURNS full turns on the
+# spot at TRACK_CALIBRATION_SPEED (deg/s per wheel)
+TRACK_CALIBRATION_TURNS = 3
+TRACK_CALIBRATION_SPEED = 200
+
+# drive motors (motor_pair.PAIR_1): port A on the left is mounted
+# mirrored, so its encoder counts down when driving forward
+LEFT_ENCODER_SIGN = -1
+RIGHT_ENCODER_SIGN = 1
+
+# how often drive/turn control loops run and yield to other coroutines
+CONTROL_FREQUENCY_HZ = 100
+CONTROL_PERIOD_MS = 1000 // CONTROL_FREQUENCY_HZ
+
+# print loop period stats at the end of every drive segment
+PRINT_LOOP_STATS = False
+
+# record yaw, encoder, steering and velocity every LOG_EVERY control
+# ticks into a ring buffer of LOG_SIZE samples, cleared when a run
+# starts and printed once at the end of execute as fixed-width hex
+# ("hex") or "csv"; decode with python -m sim.log. That is the last
+# run's log: to get another run, execute just that run, or set
+# LOG_EACH_RUN to print every run's log between runs (slows the
+# changeover). LOG_SIZE fits the longest run, run1 (1157 samples)
+LOG_SAMPLES = True
+LOG_EACH_RUN = False
+LOG_SIZE = 1200
+LOG_EVERY = 2
+LOG_FORMAT = "hex"
+
+# drive speed profile: ramp rates in deg/s^2 and the speed (deg/s) the
+# robot starts from and lands on the encoder target at
+DRIVE_ACCELERATION = 1500
+DRIVE_DECELERATION = 1500
+DRIVE_MIN_SPEED = 150
+
+# carry speed from a drive into the next drive (same direction, heading
+# within BLEND_MAX_HEADING_CHANGE degrees) or precise turn instead of
+# stopping
+BLEND_SEGMENTS = True
+BLEND_MAX_HEADING_CHANGE = 10
+# wheel acceleration (deg/s^2) for precise pivots, high enough to shed the
+# speed of a drive that rolled into the turn without a HOLD
+TURN_ACCELERATION = 4000
+
+# gyro drive gain schedule, one table per direction: rows of (velocity,
+# kp, ki, kd) by increasing velocity (deg/s), interpolated on the
+# commanded velocity every tick and held at the first/last row outside
+# it. Gains are magnitudes, scheduled_gains sets the sign.
+# Placeholders, not tuned: every speed keeps the kp 1.45 the runs were
+# tuned with on the table until rows are measured there. python -m
+# sim.tune drive can't tell kp values apart (hundredths of a cm between
+# them); what it does show is ki 0.02 taking out the ~1.3 degree heading
+# error a slipping wheel leaves, worth trying on the table first
+DRIVE_GAINS_FORWARD = (
+    (200, 1.45, 0, 0),
+    (1100, 1.45, 0, 0),
+)
+DRIVE_GAINS_REVERSE = (
+    (200, 1.45, 0, 0),
+    (1100, 1.45, 0, 0),
+)
+
+# gyro calibration: wait up to GYRO_STABLE_TIMEOUT_MS for the hub to be
+# still, then fit the yaw drift (deg/s) to a read every GYRO_SAMPLE_MS.
+# Done once GYRO_MIN_MS have passed, the fitted drift has turned the yaw
+# GYRO_MIN_TURN degrees (a few of its 0.1 degree steps) and the drift's
+# standard error is under GYRO_SETTLE_RATE, or after GYRO_CALIBRATION_MS,
+# long enough for 0.05 deg/s to show. A drift over GYRO_MAX_DRIFT means
+# the robot was moved and is thrown away
+GYRO_STABLE_TIMEOUT_MS = 1000
+GYRO_SAMPLE_MS = 10
+GYRO_MIN_MS = 200
+GYRO_CALIBRATION_MS = 5000
+GYRO_MIN_TURN = 0.3
+GYRO_SETTLE_RATE = 0.01
+GYRO_MAX_DRIFT = 0.5
+
+# how often wait_for_yaw_abs reads the yaw
+YAW_POLL_MS = 5
+
+# pivot turns: slow down proportionally within TURN_SLOW_ANGLE degrees of
+# the target (never below TURN_MIN_SPEED), brake once the predicted
+# stopping angle (yaw rate^2 / 2 * TURN_BRAKE_DECELERATION in deg/s^2,
+# plus TURN_LATENCY_MS of travel) reaches the target, then correct
+# until within TURN_TOLERANCE degrees
+TURN_SLOW_ANGLE = 20
+TURN_MIN_SPEED = 80
+TURN_BRAKE_DECELERATION = 3000
+TURN_LATENCY_MS = 20
+TURN_TOLERANCE = 1
+TURN_SETTLE_ATTEMPTS = 3
+# settling only corrects up to TURN_SETTLE_MAX degrees either way; a pivot
+# gives up after TURN_TIMEOUT_MS or once the wheels stall
+TURN_SETTLE_MAX = 30
+TURN_TIMEOUT_MS = 5000
+
+# stall/contact detection for attachment moves, MOVE pushes and drives:
+# stalled once the encoder has moved less than STALL_PROGRESS degrees in
+# STALL_WINDOW_MS, from STALL_GRACE_MS after the start and while still
+# more than STALL_MIN_REMAINING degrees short of the target
+STALL_WINDOW_MS = 100
+STALL_PROGRESS = 6
+STALL_GRACE_MS = 200
+STALL_MIN_REMAINING = 20
+# a slow pivot (a one-wheel turn at 70 deg/s makes 7 degrees a window)
+# is stalled below STALL_SLOW_SHARE of what its wheels are asked to make
+# in STALL_WINDOW_MS instead, where that is less than STALL_PROGRESS
+STALL_SLOW_SHARE = 0.3
+
+# longest a drive or arc may run before it gives up, in case its stop
+# condition (a line, a distance) is never met
+DRIVE_TIMEOUT_MS = 10000
+
+# color sensors that read field lines, left and right of the robot's
+# center ahead of the wheels. Setup constant: drive is on A/E and the
+# attachments on B/C, so the sensors go on the two free ports; change
+# these to match where they are plugged in. (tests.py is a different
+# robot with its sensors on C and D.)
+LINE_SENSOR_LEFT = port.D
+LINE_SENSOR_RIGHT = port.F
+
+# line sensor calibration: calibrate_line_sensors drives
+# LINE_CALIBRATION_DISTANCE cm at LINE_CALIBRATION_SPEED across a black
+# line and stores the darkest and brightest reflection of each sensor in
+# LINE_CALIBRATION_FILE on the hub. Less than LINE_MIN_CONTRAST between
+# them means the line was missed and nothing is stored. Uncalibrated
+# sensors use LINE_DEFAULT_BLACK/WHITE
+LINE_CALIBRATION_FILE = "line_calibration.txt"
+LINE_CALIBRATION_DISTANCE = 20
+LINE_CALIBRATION_SPEED = 200
+LINE_MIN_CONTRAST = 30
+LINE_DEFAULT_BLACK = 18
+LINE_DEFAULT_WHITE = 97
+
+# line following: PID steering on the calibrated reflection (0 black,
+# 100 white) against LINE_EDGE, the middle of the line's edge
+LINE_EDGE = 50
+LINE_KP = 0.6
+LINE_KI = 0
+LINE_KD = 2
+
+# a sensor is on a line below LINE_THRESHOLD (calibrated)
+LINE_THRESHOLD = 30
+
+# squaring on a line: each wheel drives at LINE_SQUARE_SPEED towards its
+# sensor's edge of the line, slowing within LINE_SQUARE_SLOW of LINE_EDGE
+# (never below LINE_SQUARE_MIN_SPEED) and backing up if it overshoots.
+# Square once both sensors are within LINE_SQUARE_TOLERANCE of the edge
+LINE_SQUARE_SPEED = 150
+LINE_SQUARE_SLOW = 40
+LINE_SQUARE_MIN_SPEED = 40
+LINE_SQUARE_TOLERANCE = 4
+
+# distance calibration: calibrate_distances shuttles between two lines
+# across the robot's path, DISTANCE_CALIBRATION_PITCH cm apart from edge
+# to same edge (the mat between them plus one line's width), driving
+# DISTANCE_CALIBRATION_SHORT cm less than that at every speed in
+# DISTANCE_CALIBRATION_SPEEDS both ways, DISTANCE_CALIBRATION_TRIALS
+# times, and squares on the line ahead to measure how far it really
+# went. Between drives it steps DISTANCE_CALIBRATION_CROSS cm over the
+# line to square on it from the other side. Real cm per commanded cm for
+# each speed and direction goes into DISTANCE_CALIBRATION_FILE on the
+# hub and degrees_for_distance divides by it (ignoring a scale of 0).
+# Until then DISTANCE_SCALE_FORWARD/REVERSE apply: rows of (velocity,
+# scale) by increasing velocity, interpolated like the gain schedule
+DISTANCE_CALIBRATION_FILE = "distance_calibration.txt"
+DISTANCE_CALIBRATION_PITCH = 41.5
+DISTANCE_CALIBRATION_SHORT = 4
+DISTANCE_CALIBRATION_CROSS = 4
+DISTANCE_CALIBRATION_SPEEDS = (300, 600, 900, 1100)
+DISTANCE_CALIBRATION_TRIALS = 2
+DISTANCE_SCALE_FORWARD = (
+    (0, 1.0),
+)
+DISTANCE_SCALE_REVERSE = (
+    (0, 1.0),
+)
+
+# battery compensation: a loaded motor reaches MOTOR_MAX_SPEED down to
+# MOTOR_FULL_SPEED_MV of battery and loses speed in proportion below
+# that. MOTOR_FULL_SPEED_MV is not measured: it is the pack's nominal
+# 7.2 V, which a charged battery (8.3 V) stays above for a match, so
+# the cap only comes in on a drained one. Measure it by driving at 1100
+# on a low battery and lower it if the robot still gets there. Faster
+# commands saturate the motor: speed control stops tracking, steering
+# loses authority and arms arrive late. Drive, arc, pivot, line, MOVE
+# and attachment velocities are capped at what the battery gives, so
+# profiles and the gain schedule work on the speeds the robot really
+# drives. The battery is read at the start of every run and between
+# steps at most every BATTERY_SAMPLE_MS, low-pass filtered by
+# BATTERY_FILTER against the sag of a hard move
+BATTERY_COMPENSATION = True
+MOTOR_MAX_SPEED = 1100
+MOTOR_FULL_SPEED_MV = 7200
+BATTERY_SAMPLE_MS = 1000
+BATTERY_FILTER = 0.3
+
+# waypoint paths: pivot speed, skip turns smaller than PATH_TURN_TOLERANCE
+# degrees, and treat legs within PATH_COLLINEAR_TOLERANCE degrees of each
+# other as one straight leg
+PATH_TURN_SPEED = 300
+PATH_TURN_TOLERANCE = 1
+PATH_COLLINEAR_TOLERANCE = 2
 
 # END CONSTANTS
 #----------------------------------------
@@ -20,20 +230,63 @@ WHEEL_CIRCUMFERENCE = 17.584
 # UTILITY FUNCTIONS
 #----------------------------------------
 
-# initialize motor and reset yaw
-def do_init():
-    # reset yaw to 0
+# initialize motor and reset yaw, calibrate=True also measures the gyro
+# drift (once per session, while the robot stands still)
+async def do_init(calibrate=False):
     motion_sensor.set_yaw_face(motion_sensor.TOP)
+    await wait_for_stable()
+    if calibrate:
+        heading_tracker.drift = await measure_gyro_drift()
+    # reset yaw to 0
     motion_sensor.reset_yaw(0)
-    i = 0
-    while (hub.motion_sensor.stable() == False):
-        i = i + 1
-        # Use time.sleep_ms instead of time.sleep_ms
-        # to ensure it is synchronized
-        time.sleep_ms(10)
-        hub.light_matrix.write(str(i))
-        if i >= 100:
+    heading_tracker.reset()
+    pose.reset()
+    battery.sample(force=True)
+
+
+# wait until the hub reports it is still, at most GYRO_STABLE_TIMEOUT_MS
+async def wait_for_stable():
+    start = time.ticks_ms()
+    while not motion_sensor.stable():
+        if time.ticks_diff(time.ticks_ms(), start) >= GYRO_STABLE_TIMEOUT_MS:
+            return False
+        await runloop.sleep_ms(GYRO_SAMPLE_MS)
+    return True
+
+
+# least squares slope of yaw over time in deg/s (clockwise positive)
+async def measure_gyro_drift():
+    start = time.ticks_ms()
+    n = 0
+    sum_t = sum_y = sum_tt = sum_ty = sum_yy = 0.0
+    drift = 0.0
+    while True:
+        elapsed_ms = time.ticks_diff(time.ticks_ms(), start)
+        t = elapsed_ms / 1000
+        y = get_yaw_value()
+        n += 1
+        sum_t += t
+        sum_y += y
+        sum_tt += t * t
+        sum_ty += t * y
+        sum_yy += y * y
+        spread = n * sum_tt - sum_t * sum_t
+        if n > 2 and spread > 0:
+            drift = (n * sum_ty - sum_t * sum_y) / spread
+            intercept = (sum_y - drift * sum_t) / n
+            squared_error = sum_yy - intercept * sum_y - drift * sum_ty
+            # yaw comes in 0.1 degree steps: until the drift has moved it a
+            # few steps, a slow drift fits a flat line (or one step) with
+            # next to no error, which says nothing about its rate
+            if squared_error > 0 and abs(drift) * t >= GYRO_MIN_TURN:
+                standard_error = (squared_error / (n - 2) * n / spread) ** 0.5
+                if elapsed_ms >= GYRO_MIN_MS and standard_error <= GYRO_SETTLE_RATE:
+                    break
+        if elapsed_ms >= GYRO_CALIBRATION_MS:
             break
+        await runloop.sleep_ms(GYRO_SAMPLE_MS)
+    print("Gyro drift: {:.4f} deg/s from {} samples in {} ms".format(drift, n, time.ticks_diff(time.ticks_ms(), start)))
+    return drift if abs(drift) <= GYRO_MAX_DRIFT else 0.0
 
 
 # Return true if LEFT button is pressed
@@ -46,95 +299,1534 @@ def is_right_button_pressed():
     return button.pressed(button.RIGHT) > 0
 
 
-def follow_for_distance(initial_position=0,
-                        distance_to_cover=0):
-    current_position = abs(motor.relative_position(port.A))
-    distance_covered = current_position - initial_position
-    if distance_covered < 0 : distance_covered = distance_covered * -1
-    if (distance_covered >= abs(distance_to_cover)):
-        return False
-    else:
-        return True
-
-
 def get_yaw_value():
     return motion_sensor.tilt_angles()[0] * -0.1
 
 
-def degrees_for_distance(distance_cm):
+def degrees_for_distance(distance_cm, speed=0):
     # Add multiplier for gear ratio if needed
-    return int((distance_cm/WHEEL_CIRCUMFERENCE) * 360)
-
-
-def wait_for_yaw_abs(angle=0):
-    abs_angle = abs(angle)
-    abs_current_yaw = abs(get_yaw_value())
-    if angle == 0:
-        if get_yaw_value() > 0:
-            while get_yaw_value() >= angle: time.sleep_ms(10)
-        elif get_yaw_value() < 0:
-            while get_yaw_value() <= angle: time.sleep_ms(10)
-    elif abs_current_yaw > abs_angle:
-        while abs(get_yaw_value()) >= abs_angle: time.sleep_ms(10)
-    elif abs_current_yaw < abs_angle:
-        while abs(get_yaw_value()) <= abs_angle: time.sleep_ms(10)
-
-
-async def follow_gyro_angle(kp,
-                            ki,
-                            kd,
-                            speed,
+    # speed (deg/s, negative backward), when given, corrects for how far
+    # the robot really goes at that speed, see calibrate_distances
+    degrees = (distance_cm/WHEEL_CIRCUMFERENCE) * 360
+    if speed:
+        scale = distance_scale(speed)
+        if scale > 0:
+            degrees = degrees / scale
+    return int(degrees)
+
+
+def load_distance_calibration():
+    # {1: forward rows, -1: reverse rows} of (velocity, scale) from
+    # DISTANCE_CALIBRATION_FILE, one "direction velocity scale" line per row
+    rows = {1: [], -1: []}
+    try:
+        with open(DISTANCE_CALIBRATION_FILE) as calibration_file:
+            for line in calibration_file:
+                values = line.split()
+                # a scale of 0 or less can't be real, leave the row out
+                if len(values) == 3 and int(values[0]) in rows and float(values[2]) > 0:
+                    rows[int(values[0])].append((int(values[1]), float(values[2])))
+    except (OSError, ValueError):
+        # not calibrated yet, or a damaged file
+        rows = {1: [], -1: []}
+    return {1: tuple(sorted(rows[1])) or DISTANCE_SCALE_FORWARD, -1: tuple(sorted(rows[-1])) or DISTANCE_SCALE_REVERSE}
+
+
+distance_calibration = load_distance_calibration()
+
+
+def distance_scale(velocity):
+    # real cm per commanded cm at velocity, interpolated on the table of its direction
+    table = distance_calibration[1 if velocity > 0 else -1]
+    speed = abs(velocity)
+    low = table[0]
+    if speed <= low[0]:
+        return low[1]
+    for high in table[1:]:
+        if speed <= high[0]:
+            return low[1] + (speed - low[0]) / (high[0] - low[0]) * (high[1] - low[1])
+        low = high
+    return low[1]
+
+
+def wrap_angle(angle):
+    # wrap an angle in degrees into [-180, 180)
+    return (angle + 180) % 360 - 180
+
+
+def turn_remaining(angle, yaw, direction):
+    # degrees still to turn in direction (1 right, -1 left), negative once past
+    # the target; turns of up to 330 degrees are told apart from overshoot.
+    # Only good before the turn starts: from there on compare the
+    # continuous heading with turn_target instead
+    remaining = ((angle - yaw) * direction) % 360
+    return remaining - 360 if remaining > 330 else remaining
+
+
+def turn_target(angle, heading, direction):
+    # continuous heading (see HeadingTracker) at which a turn from heading
+    # in direction reaches the yaw angle; (target - heading) * direction is
+    # then what remains, negative by however much the turn overshoots
+    return heading + turn_remaining(angle, wrap_angle(heading), direction) * direction
+
+
+# Continuous heading shared by every motion primitive. update() reads
+# the gyro once, unwraps the +-180 yaw into a heading that keeps
+# counting past 180 and measures the yaw rate (deg/s, clockwise
+# positive). Call it once per control tick and read heading/rate from
+# the tracker instead of going back to the sensor. The gyro drift
+# measured by do_init(calibrate=True) is taken off every update.
+class HeadingTracker:
+
+    def __init__(self):
+        # deg/s, clockwise positive
+        self.drift = 0.0
+        self.reset()
+
+    def reset(self):
+        # call after motion_sensor.reset_yaw
+        self.heading = 0.0
+        self.rate = 0.0
+        self.last_yaw = None
+        # heading and time the rate was last measured from
+        self.rate_heading = 0.0
+        self.rate_us = 0
+        self.last_us = 0
+
+    def update(self):
+        yaw = get_yaw_value()
+        now = time.ticks_us()
+        if self.last_yaw is None:
+            self.heading = yaw
+            self.rate_heading = yaw
+            self.rate_us = now
+        else:
+            self.heading += wrap_angle(yaw - self.last_yaw) - self.drift * time.ticks_diff(now, self.last_us) / 1000000
+            # several updates in the same tick would make the rate noisy
+            elapsed_us = time.ticks_diff(now, self.rate_us)
+            if elapsed_us >= 2000:
+                self.rate = (self.heading - self.rate_heading) * 1000000 / elapsed_us
+                self.rate_heading = self.heading
+                self.rate_us = now
+        self.last_yaw = yaw
+        self.last_us = now
+        return self.heading
+
+    def yaw(self):
+        # heading wrapped into [-180, 180) like get_yaw_value
+        return wrap_angle(self.heading)
+
+
+heading_tracker = HeadingTracker()
+
+
+# Hub battery voltage (mV) and the fastest the motors turn on it.
+# sample() reads the battery at most every BATTERY_SAMPLE_MS unless
+# forced, limit() caps a commanded velocity at max_speed.
+class Battery:
+
+    def __init__(self):
+        self.voltage = 0
+        self.max_speed = MOTOR_MAX_SPEED
+        self.last_ms = None
+
+    def sample(self, force=False):
+        now = time.ticks_ms()
+        if not force and self.last_ms is not None and time.ticks_diff(now, self.last_ms) < BATTERY_SAMPLE_MS:
+            return self.voltage
+        reading = hub.battery_voltage()
+        if force or not self.voltage:
+            self.voltage = reading
+        else:
+            self.voltage += BATTERY_FILTER * (reading - self.voltage)
+        self.last_ms = now
+        self.max_speed = min(MOTOR_MAX_SPEED, int(MOTOR_MAX_SPEED * self.voltage / MOTOR_FULL_SPEED_MV))
+        return self.voltage
+
+    def limit(self, velocity):
+        if not BATTERY_COMPENSATION or abs(velocity) <= self.max_speed:
+            return velocity
+        return self.max_speed if velocity > 0 else -self.max_speed
+
+
+battery = Battery()
+
+
+# Field pose from both drive encoders and the gyro heading. update()
+# reads ports A and E once, adds the average wheel travel to travel
+# (forward wheel degrees, never reset during a run) and integrates x/y
+# in cm along the heading. Call it every control tick after the
+# heading tracker.
+class PoseEstimator:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, x=0.0, y=0.0):
+        self.x = x
+        self.y = y
+        self.travel = 0.0
+        self.last_left = None
+        self.last_right = None
+
+    def update(self, heading):
+        left = LEFT_ENCODER_SIGN * motor.relative_position(port.A)
+        right = RIGHT_ENCODER_SIGN * motor.relative_position(port.E)
+        if self.last_left is not None:
+            step = ((left - self.last_left) + (right - self.last_right)) / 2
+            self.travel += step
+            distance = step * WHEEL_CIRCUMFERENCE / 360
+            radians = math.radians(heading)
+            self.x += distance * math.cos(radians)
+            self.y += distance * math.sin(radians)
+        self.last_left = left
+        self.last_right = right
+        return self.travel
+
+
+pose = PoseEstimator()
+
+
+# Wait until the yaw reaches angle turning in direction (1 right, -1
+# left, 0 the shorter way from here). Reads the sensor once per tick
+# every poll_ms, and once the yaw rate says the target is less than a
+# tick away, sleeps just until the predicted crossing instead.
+async def wait_for_yaw_abs(angle=0, velocity=0, direction=0, poll_ms=YAW_POLL_MS):
+    heading = heading_tracker.update()
+    if direction == 0:
+        direction = 1 if wrap_angle(angle - heading) >= 0 else -1
+    target = turn_target(angle, heading, direction)
+    start = time.ticks_ms()
+    while True:
+        remaining = (target - heading) * direction
+        if remaining <= 0 or time.ticks_diff(time.ticks_ms(), start) >= TURN_TIMEOUT_MS:
+            return
+        # yaw rate in deg/s in the turn direction
+        rate = heading_tracker.rate * direction
+        if rate > 0:
+            eta_ms = remaining * 1000 / rate
+            if eta_ms < poll_ms:
+                await runloop.sleep_ms(int(eta_ms))
+                return
+        if LOG_SAMPLES:
+            sample_log.append(heading, int(pose.travel), 0, velocity)
+        await runloop.sleep_ms(poll_ms)
+        heading = heading_tracker.update()
+        pose.update(heading)
+
+
+# Fixed-rate control loop timer. Await tick() once per iteration: it
+# sleeps until the next period boundary and returns the measured time
+# since the previous tick in units of the nominal period (1.0 when on
+# time), so I and D terms keep the same meaning at any loop rate.
+# Also records min/mean/max loop period and jitter for the segment.
+class ControlLoop:
+
+    def __init__(self, frequency_hz=CONTROL_FREQUENCY_HZ):
+        self.period_us = 1000000 // frequency_hz
+        self.count = 0
+        self.min_us = 0
+        self.max_us = 0
+        self.total_us = 0
+        self.total_sq_us = 0.0
+        self.last_tick = time.ticks_us()
+        self.next_tick = time.ticks_add(self.last_tick, self.period_us)
+
+    async def tick(self):
+        wait_ms = time.ticks_diff(self.next_tick, time.ticks_us()) // 1000
+        await runloop.sleep_ms(wait_ms if wait_ms > 0 else 0)
+        now = time.ticks_us()
+        dt_us = time.ticks_diff(now, self.last_tick)
+        self.last_tick = now
+        # fell behind (slow stop conditions, prints): restart the schedule from now
+        self.next_tick = time.ticks_add(self.next_tick, self.period_us)
+        if time.ticks_diff(self.next_tick, now) <= 0:
+            self.next_tick = time.ticks_add(now, self.period_us)
+
+        if self.count == 0 or dt_us < self.min_us: self.min_us = dt_us
+        if dt_us > self.max_us: self.max_us = dt_us
+        self.count += 1
+        self.total_us += dt_us
+        self.total_sq_us += dt_us * dt_us
+        return dt_us / self.period_us if dt_us > 0 else 1.0
+
+    def mean_us(self):
+        return self.total_us / self.count if self.count else 0
+
+    def jitter_us(self):
+        # standard deviation of the loop period
+        if not self.count:
+            return 0
+        variance = self.total_sq_us / self.count - self.mean_us() ** 2
+        return variance ** 0.5 if variance > 0 else 0
+
+    def report(self, label=""):
+        print("{} loops={} period min/mean/max={:.1f}/{:.1f}/{:.1f} ms jitter={:.2f} ms".format(
+            label, self.count, self.min_us / 1000, self.mean_us() / 1000, self.max_us / 1000,
+            self.jitter_us() / 1000))
+
+
+# Preallocated ring buffer of control-loop samples, no allocation per
+# sample. Each sample is (time_ms, segment, yaw_decideg, position,
+# steering, velocity); new_segment() starts the next segment id and
+# keeps its first sample, then every LOG_EVERY-th is kept. reset()
+# starts over for the next run, time and segment ids from 0.
+class SampleLog:
+
+    FIELDS = 6
+
+    def __init__(self, size=LOG_SIZE):
+        self.size = size
+        self.data = array.array("i", (0 for _ in range(size * self.FIELDS)))
+        self.reset()
+
+    def reset(self):
+        self.next = 0
+        self.count = 0
+        self.segment = 0
+        self.skipped = 0
+        self.start_ms = time.ticks_ms()
+
+    def new_segment(self):
+        self.segment += 1
+        self.skipped = 0
+
+    def append(self, yaw, position, steering, velocity):
+        if self.skipped:
+            self.skipped = (self.skipped + 1) % LOG_EVERY
+            return
+        self.skipped = 1 % LOG_EVERY
+        data = self.data
+        i = self.next * self.FIELDS
+        data[i] = time.ticks_diff(time.ticks_ms(), self.start_ms)
+        data[i + 1] = self.segment
+        data[i + 2] = int(yaw * 10)
+        data[i + 3] = position
+        data[i + 4] = steering
+        data[i + 5] = velocity
+        self.next = (self.next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def flush(self, run_number=0, format=LOG_FORMAT):
+        # oldest sample first, one line per sample between LOG and END LOG
+        print("LOG " + format + " " + str(self.FIELDS) + " " + str(self.count) + " run " + str(run_number))
+        first = (self.next - self.count) % self.size
+        for k in range(self.count):
+            i = ((first + k) % self.size) * self.FIELDS
+            values = self.data[i:i + self.FIELDS]
+            if format == "csv":
+                print(",".join(str(value) for value in values))
+            else:
+                print("".join("%08x" % (value & 0xffffffff) for value in values))
+        print("END LOG")
+
+
+sample_log = SampleLog()
+
+
+# Trapezoidal speed profile for a drive of distance encoder degrees:
+# ramp up from start_speed, cruise at speed, then ramp down so the
+# robot reaches the target at end_speed. Position based, so it
+# follows the robot rather than the clock.
+def profile_velocity(speed, covered, distance, start_speed=DRIVE_MIN_SPEED, end_speed=DRIVE_MIN_SPEED):
+    remaining = abs(distance) - covered
+    if remaining < 0: remaining = 0
+    ramp_up = (start_speed * start_speed + 2 * DRIVE_ACCELERATION * covered) ** 0.5
+    ramp_down = (end_speed * end_speed + 2 * DRIVE_DECELERATION * remaining) ** 0.5
+    velocity = min(abs(speed), ramp_up, ramp_down)
+    return int(velocity) if speed > 0 else -int(velocity)
+
+
+def scheduled_gains(velocity):
+    # (kp, ki, kd) for a commanded velocity from the gain schedule of its
+    # direction, signed -ve for forward and +ve for backward movement
+    table = DRIVE_GAINS_FORWARD if velocity > 0 else DRIVE_GAINS_REVERSE
+    sign = -1 if velocity > 0 else 1
+    speed = abs(velocity)
+    low = table[0]
+    if speed <= low[0]:
+        return sign * low[1], sign * low[2], sign * low[3]
+    for high in table[1:]:
+        if speed <= high[0]:
+            f = (speed - low[0]) / (high[0] - low[0])
+            return (sign * (low[1] + f * (high[1] - low[1])), sign * (low[2] + f * (high[2] - low[2])),
+                    sign * (low[3] + f * (high[3] - low[3])))
+        low = high
+    return sign * low[1], sign * low[2], sign * low[3]
+
+
+async def follow_gyro_angle(speed,
                             target_angle,
-                            sleep_time,
-                            follow_for, **kwargs):
-    # get initial reading from left motor
+                            until,
+                            kp=None,
+                            ki=0,
+                            kd=0,
+                            sleep_time=0,
+                            frequency_hz=CONTROL_FREQUENCY_HZ,
+                            profile_distance=0,
+                            start_speed=DRIVE_MIN_SPEED,
+                            end_speed=DRIVE_MIN_SPEED,
+                            stop=True,
+                            timeout_ms=DRIVE_TIMEOUT_MS):
+    # drive until the stop condition until is met, the robot is blocked
+    # or timeout_ms have passed
+    speed = battery.limit(speed)
+    until = Any(until, Stalled(), Elapsed(timeout_ms))
+    snapshot = Snapshot(until.ports)
+    # sleep_time (ms), when set, overrides the control frequency
+    loop = ControlLoop(1000 // sleep_time if sleep_time else frequency_hz)
+    # profile_distance (encoder degrees), when set, ramps speed up and
+    # down over that distance instead of driving at a constant speed,
+    # from start_speed to end_speed (deg/s) for blended segments
+    velocity = speed
+    # kp=None takes kp, ki and kd from the gain schedule for the commanded
+    # (profiled) velocity, otherwise the given gains are used as they are
+    scheduled = kp is None
+    gains_velocity = None
+    sample_log.new_segment()
     integral = 0.0
     last_error = 0.0
     derivative = 0.0
-    while (follow_for(**kwargs)):
-        current_angle = get_yaw_value()
-        error = current_angle - target_angle
-        integral = integral + error
-        derivative = error - last_error
+    # time since the previous tick, in control periods
+    dt = 1.0
+    current_angle = heading_tracker.update()
+    travel = pose.update(current_angle)
+    start_travel = travel
+    snapshot.update(current_angle, travel)
+    until.start(snapshot)
+    while not until.met(snapshot):
+        error = wrap_angle(current_angle - target_angle)
+        integral = integral + error * dt
+        derivative = (error - last_error) / dt
         last_error = error
+        if profile_distance:
+            velocity = profile_velocity(speed, abs(travel - start_travel), profile_distance, start_speed, end_speed)
+        if scheduled and velocity != gains_velocity:
+            kp, ki, kd = scheduled_gains(velocity)
+            gains_velocity = velocity
+
         # compute steering correction
         steering_value = (error * kp) + (integral * ki) + (derivative * kd)
 
-        if sleep_time:
-            time.sleep_ms(sleep_time)
         # kp value should be +ve for forward movement (positive speed value), and -ve for backward movement (negative speed value)
-        motor_pair.move(motor_pair.PAIR_1, int(steering_value), velocity=speed)
-
-    # stop when follow_for condition is met
+        # the profile sets the ramps, so let the motors follow it as fast as they can
+        motor_pair.move(motor_pair.PAIR_1, int(steering_value), velocity=velocity,
+                        acceleration=10000 if profile_distance else 1000)
+        if LOG_SAMPLES:
+            sample_log.append(current_angle, int(travel), int(steering_value), velocity)
+
+        # yield to other coroutines (attachments) until the next control tick
+        dt = await loop.tick()
+        current_angle = heading_tracker.update()
+        travel = pose.update(current_angle)
+        snapshot.update(current_angle, travel)
+
+    # stop when the condition is met, unless the next segment takes over at speed
+    if stop: motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
+    if PRINT_LOOP_STATS:
+        loop.report("follow_gyro_angle " + str(target_angle))
+    return loop
+
+
+async def pivot_gyro_turn_abs(left_speed=0, right_speed=50, angle=90, stop=False, precise=True):
+    # precise=False turns at full speed until the target is crossed, for
+    # moves that rely on momentum (run5 habitat flick)
+    fastest = max(abs(left_speed), abs(right_speed))
+    if battery.limit(fastest) < fastest:
+        # keep the ratio between the wheels
+        scale = battery.limit(fastest) / fastest
+        left_speed = int(left_speed * scale)
+        right_speed = int(right_speed * scale)
+        fastest = battery.limit(fastest)
+    if fastest == 0:
+        return
+    motor_pair.move_tank(motor_pair.PAIR_1, left_speed, right_speed,
+                         acceleration=TURN_ACCELERATION if precise else 1000)
+    sample_log.new_segment()
+    # turning right (clockwise) when the left wheel is faster
+    direction = 1 if left_speed > right_speed else -1
+    if not precise:
+        await wait_for_yaw_abs(angle=angle, velocity=left_speed, direction=direction)
+        if stop: motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
+        return
+
+    min_scale = min(1, TURN_MIN_SPEED / fastest)
+    loop = ControlLoop()
+    target = turn_target(angle, heading_tracker.update(), direction)
+    start = time.ticks_ms()
+    # the wheels turn opposite ways (or one of them does): watch their difference
+    pose.update(heading_tracker.heading)
+    detector = StallDetector(pose.last_left - pose.last_right)
+    scale = 1
+    while True:
+        await loop.tick()
+        yaw = heading_tracker.update()
+        pose.update(yaw)
+        # yaw rate in deg/s in the turn direction
+        rate = heading_tracker.rate * direction
+        remaining = (target - yaw) * direction
+        stopping = (rate * rate / (2 * TURN_BRAKE_DECELERATION) + rate * TURN_LATENCY_MS / 1000) if rate > 0 else 0
+        if remaining <= stopping:
+            break
+        least = turn_stall_progress(left_speed * scale, right_speed * scale)
+        if (detector.update(pose.last_left - pose.last_right, least)
+                or time.ticks_diff(time.ticks_ms(), start) >= TURN_TIMEOUT_MS):
+            # blocked: don't try to settle against whatever holds the robot
+            motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
+            return
+        scale = min(1, max(min_scale, remaining / TURN_SLOW_ANGLE))
+        motor_pair.move_tank(motor_pair.PAIR_1, int(left_speed * scale), int(right_speed * scale),
+                             acceleration=TURN_ACCELERATION)
+        if LOG_SAMPLES:
+            sample_log.append(yaw, int(pose.travel), 0, int(left_speed * scale))
+
+    if not stop:
+        return
     motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
 
+    # settle: nudge back at TURN_MIN_SPEED until within tolerance, only
+    # small corrections and never past TURN_TIMEOUT_MS or a stall
+    settle_progress = turn_stall_progress(left_speed * min_scale, right_speed * min_scale)
+    for _ in range(TURN_SETTLE_ATTEMPTS):
+        await runloop.sleep_ms(TURN_LATENCY_MS)
+        remaining = (target - heading_tracker.update()) * direction
+        if abs(remaining) <= TURN_TOLERANCE or abs(remaining) > TURN_SETTLE_MAX:
+            break
+        sign = 1 if remaining > 0 else -1
+        motor_pair.move_tank(motor_pair.PAIR_1, int(left_speed * min_scale * sign), int(right_speed * min_scale * sign))
+        pose.update(heading_tracker.heading)
+        detector.reset(pose.last_left - pose.last_right)
+        blocked = False
+        while (target - heading_tracker.update()) * direction * sign > TURN_TOLERANCE / 2:
+            pose.update(heading_tracker.heading)
+            if (detector.update(pose.last_left - pose.last_right, settle_progress)
+                    or time.ticks_diff(time.ticks_ms(), start) >= TURN_TIMEOUT_MS):
+                blocked = True
+                break
+            await runloop.sleep_ms(CONTROL_PERIOD_MS)
+        motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
+        if blocked:
+            break
 
-async def pivot_gyro_turn_abs(left_speed=0, right_speed=50, angle=90, stop=False):
-    motor_pair.move_tank(motor_pair.PAIR_1, left_speed, right_speed)
-    wait_for_yaw_abs(angle=angle)
-    if stop: motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
 
+# Drive an arc of radius cm on both drive motors (positive curves right,
+# negative left; speed of the outer wheel in deg/s, negative backward)
+# until the heading reaches angle or the robot has covered degrees
+# encoder degrees, whichever comes first. The gyro keeps the heading on
+# the one expected for the distance covered so far. Backing up, the
+# path still bends to the robot's right or left, which turns it the
+# other way: negative speed and radius turns clockwise.
+async def arc_gyro_turn(speed, radius, angle=None, degrees=0, stop=True, timeout_ms=DRIVE_TIMEOUT_MS):
+    if radius == 0:
+        # no curve direction and nothing to divide the distance by; pivot instead
+        print("arc_gyro_turn: radius 0, use a TURN")
+        return None
+    speed = battery.limit(speed)
+    half_track = TRACK_WIDTH / 2
+    # steering that gives the radius: the inner wheel runs at (r - w/2) / (r + w/2) of the outer one
+    ratio = (abs(radius) - half_track) / (abs(radius) + half_track)
+    steering = 50 * (1 - ratio) * (1 if radius > 0 else -1)
+    # clockwise when curving right going forward, or left going backward
+    direction = 1 if (radius > 0) == (speed > 0) else -1
+    until = Any(Stalled(), Elapsed(timeout_ms))
+    if degrees:
+        until = Any(until, Distance(degrees))
+    if angle is not None:
+        until = Any(until, Heading(angle, direction, TURN_LATENCY_MS))
+    snapshot = Snapshot(until.ports)
+    kp, ki, kd = scheduled_gains(speed)
+    loop = ControlLoop()
+    sample_log.new_segment()
+    heading = heading_tracker.update()
+    travel = pose.update(heading)
+    start_heading = heading
+    start_travel = travel
+    snapshot.update(heading, travel)
+    until.start(snapshot)
+    last_error = 0.0
+    dt = 1.0
+    while not until.met(snapshot):
+        covered = abs(travel - start_travel)
+        expected = start_heading + direction * math.degrees(covered * WHEEL_CIRCUMFERENCE / 360 / abs(radius))
+        error = heading - expected
+        correction = error * kp + (error - last_error) / dt * kd
+        last_error = error
+        motor_pair.move(motor_pair.PAIR_1, int(steering + correction), velocity=speed, acceleration=TURN_ACCELERATION)
+        if LOG_SAMPLES:
+            sample_log.append(heading, int(travel), int(steering + correction), speed)
+        dt = await loop.tick()
+        heading = heading_tracker.update()
+        travel = pose.update(heading)
+        snapshot.update(heading, travel)
+    if stop: motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
+    return loop
 
-def get_yaw_angle():
-    current_yaw = motion_sensor.tilt_angles()[0] * -0.1
-    if (current_yaw < 0):
-        return (current_yaw + 360)
-    return current_yaw
 
+# Measure TRACK_WIDTH: place the robot with room to spin and start it.
+# It pivots TRACK_CALIBRATION_TURNS full turns on the spot; each wheel
+# rolls pi * track per turn, so the track is how far the wheels rolled
+# over how far the gyro says the robot turned. Prints the value to copy
+# into CONSTANTS and returns it. Runs on its own (see the slots at the
+# end), not as part of a run.
+async def calibrate_track_width(turns=TRACK_CALIBRATION_TURNS, speed=TRACK_CALIBRATION_SPEED):
+    motor_pair.pair(motor_pair.PAIR_1, port.A, port.E)
+    await do_init()
+    start_heading = heading_tracker.update()
+    pose.update(start_heading)
+    start_left = pose.last_left
+    start_right = pose.last_right
+    motor_pair.move_tank(motor_pair.PAIR_1, speed, -speed, acceleration=TURN_ACCELERATION)
+    loop = ControlLoop()
+    start = time.ticks_ms()
+    while heading_tracker.update() - start_heading < turns * 360:
+        # a turn takes under 4 s at 200 deg/s; TURN_TIMEOUT_MS a turn is stuck
+        if time.ticks_diff(time.ticks_ms(), start) >= turns * TURN_TIMEOUT_MS:
+            motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
+            print("Track width calibration failed: the robot didn't turn")
+            light.color(light.POWER, color.RED)
+            return None
+        await loop.tick()
+    motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
+    # let HOLD settle before reading where the turn ended
+    await runloop.sleep_ms(TURN_LATENCY_MS * 5)
+    turned = heading_tracker.update() - start_heading
+    pose.update(heading_tracker.heading)
+    rolled = (abs(pose.last_left - start_left) + abs(pose.last_right - start_right)) / 2 * WHEEL_CIRCUMFERENCE / 360
+    track = rolled * 360 / (math.pi * turned)
+    print("TRACK_WIDTH = {:.2f}".format(track))
+    light.color(light.POWER, color.GREEN)
+    return track
+
+
+# spin right/left until the yaw angle (0-360 or +-180)
 async def turnRight(angle):
     motor_pair.move_tank(motor_pair.PAIR_1, 200, -200)
-    while abs(get_yaw_angle()) <= angle: time.sleep_ms(10)
+    await wait_for_yaw_abs(angle=wrap_angle(angle), velocity=200, direction=1)
     motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
 
 async def turnLeft(angle):
     motor_pair.move_tank(motor_pair.PAIR_1, -200, 200)
-    while abs(get_yaw_angle()) >= angle: time.sleep_ms(10)
+    await wait_for_yaw_abs(angle=wrap_angle(angle), velocity=-200, direction=-1)
     motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
 
 
+# Watches an encoder (motor position or pose.travel) once per control
+# tick. update() is True once the position made less than STALL_PROGRESS
+# degrees of progress over the last STALL_WINDOW_MS, from STALL_GRACE_MS
+# after reset.
+class StallDetector:
+
+    def __init__(self, position=0):
+        self.reset(position)
+
+    def reset(self, position=0):
+        self.start_us = time.ticks_us()
+        self.window_us = self.start_us
+        self.window_position = position
+
+    def update(self, position, least=STALL_PROGRESS):
+        # least: the progress per window below which it counts as stalled
+        now = time.ticks_us()
+        if time.ticks_diff(now, self.window_us) < STALL_WINDOW_MS * 1000:
+            return False
+        progress = abs(position - self.window_position)
+        self.window_us = now
+        self.window_position = position
+        return progress < least and time.ticks_diff(now, self.start_us) >= STALL_GRACE_MS * 1000
+
+
+def turn_stall_progress(left_speed, right_speed):
+    # least progress of the wheels' difference per stall window for a pivot
+    # commanded at left_speed, right_speed (deg/s)
+    asked = abs(left_speed - right_speed) * STALL_WINDOW_MS / 1000
+    return min(STALL_PROGRESS, asked * STALL_SLOW_SHARE)
+
+
+# Await move (a motor command) while watching read_position() every
+# control tick; call stop() and return True if it stalls short of target
+async def run_until_stalled(move, read_position, target, stop):
+    # finished, stalled
+    state = [False, False]
+    async def finish():
+        await move
+        state[0] = True
+    async def watch():
+        detector = StallDetector(read_position())
+        while not state[0]:
+            await runloop.until(lambda: state[0], CONTROL_PERIOD_MS)
+            if state[0]:
+                return
+            position = read_position()
+            if abs(target - position) > STALL_MIN_REMAINING and detector.update(position):
+                state[1] = True
+                stop()
+                return
+    await runloop.gather(finish(), watch())
+    return state[1]
+
+
+def degrees_target(position, degrees, speed):
+    # where a run_for_degrees/move_for_degrees command ends, the signs of
+    # degrees and speed both set the direction
+    return position + abs(degrees) if (degrees >= 0) == (speed >= 0) else position - abs(degrees)
+
+
+# the robot is square against a model at a known heading: make the gyro agree
+def rezero_heading(heading):
+    motion_sensor.reset_yaw(int(-wrap_angle(heading) * 10))
+    heading_tracker.reset()
+    heading_tracker.update()
+
+
+# STOP CONDITIONS
+#----------------------------------------
+# When a drive or arc ends, built once per move from the classes below
+# and combined with Any/All. The control loop fills one Snapshot per
+# tick (heading, rate and travel from the trackers it already updated,
+# the time, and the reflection of only the color sensors the conditions
+# use) and every condition reads from it instead of the hardware.
+
+class Snapshot:
+
+    def __init__(self, ports=()):
+        self.ports = ports
+        self.reflection = {}
+        self.heading = 0.0
+        self.rate = 0.0
+        self.travel = 0.0
+        self.now_ms = 0
+
+    def update(self, heading, travel):
+        self.heading = heading
+        self.rate = heading_tracker.rate
+        self.travel = travel
+        self.now_ms = time.ticks_ms()
+        for sensor_port in self.ports:
+            self.reflection[sensor_port] = color_sensor.reflection(sensor_port)
+
+
+class Condition:
+    # color sensor ports the condition reads
+    ports = ()
+
+    def start(self, snapshot):
+        # called once when the move starts
+        pass
+
+    def met(self, snapshot):
+        return False
+
+
+# pose.travel reached target_travel driving in direction (1 forward, -1 backward)
+class Travel(Condition):
+
+    def __init__(self, target_travel, direction=1):
+        self.target_travel = target_travel
+        self.direction = direction
+
+    def met(self, snapshot):
+        return (self.target_travel - snapshot.travel) * self.direction <= 0
+
+
+# covered degrees of travel, either way, since the move started
+class Distance(Condition):
+
+    def __init__(self, degrees):
+        self.degrees = degrees
+        self.start_travel = 0.0
+
+    def start(self, snapshot):
+        self.start_travel = snapshot.travel
+
+    def met(self, snapshot):
+        return abs(snapshot.travel - self.start_travel) >= self.degrees
+
+
+# reflection (percent) on the color sensor at sensor_port below or above a threshold
+class Reflection(Condition):
+
+    def __init__(self, sensor_port, below=None, above=None):
+        self.ports = (sensor_port,)
+        self.sensor_port = sensor_port
+        self.below = below
+        self.above = above
+
+    def met(self, snapshot):
+        value = snapshot.reflection[self.sensor_port]
+        return ((self.below is not None and value < self.below)
+                or (self.above is not None and value > self.above))
+
+
+# heading reached angle turning in direction (1 right, -1 left), lead_ms
+# early at the current yaw rate
+class Heading(Condition):
+
+    def __init__(self, angle, direction, lead_ms=0):
+        self.angle = angle
+        self.direction = direction
+        self.lead_ms = lead_ms
+        self.target = 0.0
+
+    def start(self, snapshot):
+        self.target = turn_target(self.angle, snapshot.heading, self.direction)
+
+    def met(self, snapshot):
+        rate = snapshot.rate * self.direction
+        lead = rate * self.lead_ms / 1000 if rate > 0 else 0
+        return (self.target - snapshot.heading) * self.direction <= lead
+
+
+class Elapsed(Condition):
+
+    def __init__(self, ms):
+        self.ms = ms
+        self.start_ms = 0
+
+    def start(self, snapshot):
+        self.start_ms = snapshot.now_ms
+
+    def met(self, snapshot):
+        return time.ticks_diff(snapshot.now_ms, self.start_ms) >= self.ms
+
+
+# the robot is blocked (see StallDetector)
+class Stalled(Condition):
+
+    def __init__(self):
+        self.detector = StallDetector()
+
+    def start(self, snapshot):
+        self.detector.reset(snapshot.travel)
+
+    def met(self, snapshot):
+        return self.detector.update(snapshot.travel)
+
+
+class Any(Condition):
+
+    def __init__(self, *conditions):
+        self.conditions = conditions
+        ports = []
+        for condition in conditions:
+            for sensor_port in condition.ports:
+                if sensor_port not in ports:
+                    ports.append(sensor_port)
+        self.ports = tuple(ports)
+        # the condition that ended the move
+        self.reason = None
+
+    def start(self, snapshot):
+        self.reason = None
+        for condition in self.conditions:
+            condition.start(snapshot)
+
+    def met(self, snapshot):
+        for condition in self.conditions:
+            if condition.met(snapshot):
+                self.reason = condition
+                return True
+        return False
+
+
+class All(Any):
+
+    def met(self, snapshot):
+        # every condition is checked each tick so stateful ones keep up
+        met = True
+        for condition in self.conditions:
+            if not condition.met(snapshot):
+                met = False
+        return met
+
+
+# calibrated reflection of the color sensor at sensor_port below LINE_THRESHOLD
+class OnLine(Condition):
+
+    def __init__(self, sensor_port):
+        self.ports = (sensor_port,)
+        self.sensor_port = sensor_port
+
+    def met(self, snapshot):
+        return line_level(self.sensor_port, snapshot.reflection[self.sensor_port]) < LINE_THRESHOLD
+
+
+# LINE SENSORS
+#----------------------------------------
+# Field lines to re-localize on. Raw reflection differs from sensor to
+# sensor and with the light on the table, so every reading goes through
+# line_level, which maps it onto 0 (black) .. 100 (white) using the
+# darkest and brightest values calibrate_line_sensors stored on the hub.
+
+def load_line_calibration():
+    # {sensor port: (black, white)} from LINE_CALIBRATION_FILE, one
+    # "port black white" line per sensor
+    calibration = {}
+    for sensor_port in (LINE_SENSOR_LEFT, LINE_SENSOR_RIGHT):
+        calibration[sensor_port] = (LINE_DEFAULT_BLACK, LINE_DEFAULT_WHITE)
+    try:
+        with open(LINE_CALIBRATION_FILE) as calibration_file:
+            for line in calibration_file:
+                values = [int(value) for value in line.split()]
+                if len(values) == 3 and values[2] > values[1]:
+                    calibration[values[0]] = (values[1], values[2])
+    except (OSError, ValueError):
+        # not calibrated yet, or a damaged file
+        pass
+    return calibration
+
+
+line_calibration = load_line_calibration()
+
+
+def line_level(sensor_port, reflection):
+    black, white = line_calibration[sensor_port]
+    level = (reflection - black) * 100 // (white - black)
+    if level < 0: return 0
+    if level > 100: return 100
+    return level
+
+
+# keeps the darkest and brightest reflection seen on ports, never met
+class ReflectionRange(Condition):
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.darkest = {}
+        self.brightest = {}
+        for sensor_port in ports:
+            self.darkest[sensor_port] = 100
+            self.brightest[sensor_port] = 0
+
+    def met(self, snapshot):
+        for sensor_port in self.ports:
+            value = snapshot.reflection[sensor_port]
+            if value < self.darkest[sensor_port]: self.darkest[sensor_port] = value
+            if value > self.brightest[sensor_port]: self.brightest[sensor_port] = value
+        return False
+
+
+# Calibrate the line sensors: place the robot with both sensors on the
+# mat a few cm before a black line across its path and start it. Runs on
+# its own (see the slots at the end), not as part of a run.
+async def calibrate_line_sensors(distance_cm=LINE_CALIBRATION_DISTANCE, speed=LINE_CALIBRATION_SPEED):
+    motor_pair.pair(motor_pair.PAIR_1, port.A, port.E)
+    await do_init()
+    ports = (LINE_SENSOR_LEFT, LINE_SENSOR_RIGHT)
+    seen = ReflectionRange(ports)
+    await follow_gyro_angle(speed=speed, target_angle=0, until=Any(seen, Distance(degrees_for_distance(distance_cm))))
+    for sensor_port in ports:
+        if seen.brightest[sensor_port] - seen.darkest[sensor_port] < LINE_MIN_CONTRAST:
+            print("Line calibration failed: port {} saw {}..{}".format(
+                sensor_port, seen.darkest[sensor_port], seen.brightest[sensor_port]))
+            light.color(light.POWER, color.RED)
+            return False
+    with open(LINE_CALIBRATION_FILE, "w") as calibration_file:
+        for sensor_port in ports:
+            line_calibration[sensor_port] = (seen.darkest[sensor_port], seen.brightest[sensor_port])
+            calibration_file.write("{} {} {}\n".format(sensor_port, seen.darkest[sensor_port],
+                                                       seen.brightest[sensor_port]))
+            print("Line sensor {}: black {} white {}".format(sensor_port, seen.darkest[sensor_port],
+                                                              seen.brightest[sensor_port]))
+    light.color(light.POWER, color.GREEN)
+    return True
+
+
+# Follow the edge of a line with the color sensor at sensor_port, forward
+# at speed, until the stop condition until is met, the robot is blocked
+# or timeout_ms have passed. side 1 follows the line's right edge (line
+# to the left of the sensor), -1 its left edge.
+async def follow_line(speed, sensor_port, until, side=1, kp=LINE_KP, ki=LINE_KI, kd=LINE_KD, stop=True,
+                      timeout_ms=DRIVE_TIMEOUT_MS):
+    speed = battery.limit(speed)
+    until = Any(until, Stalled(), Elapsed(timeout_ms))
+    ports = until.ports if sensor_port in until.ports else until.ports + (sensor_port,)
+    snapshot = Snapshot(ports)
+    loop = ControlLoop()
+    sample_log.new_segment()
+    integral = 0.0
+    last_error = 0.0
+    dt = 1.0
+    heading = heading_tracker.update()
+    travel = pose.update(heading)
+    snapshot.update(heading, travel)
+    until.start(snapshot)
+    while not until.met(snapshot):
+        # darker than the edge: the sensor is over the line, steer off it
+        error = line_level(sensor_port, snapshot.reflection[sensor_port]) - LINE_EDGE
+        integral = integral + error * dt
+        derivative = (error - last_error) / dt
+        last_error = error
+        steering_value = -side * ((error * kp) + (integral * ki) + (derivative * kd))
+        motor_pair.move(motor_pair.PAIR_1, int(steering_value), velocity=speed)
+        if LOG_SAMPLES:
+            sample_log.append(heading, int(travel), int(steering_value), speed)
+        dt = await loop.tick()
+        heading = heading_tracker.update()
+        travel = pose.update(heading)
+        snapshot.update(heading, travel)
+    if stop: motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
+    return loop
+
+
+def square_speed(speed, level):
+    # wheel speed that brings a sensor reading level onto the line's edge
+    error = level - LINE_EDGE
+    if abs(error) <= LINE_SQUARE_TOLERANCE:
+        return 0
+    scale = min(1, max(-1, error / LINE_SQUARE_SLOW))
+    velocity = int(speed * scale)
+    if abs(velocity) < LINE_SQUARE_MIN_SPEED:
+        return LINE_SQUARE_MIN_SPEED if velocity > 0 else -LINE_SQUARE_MIN_SPEED
+    return velocity
+
+
+# Square up on a line across the path: drive both wheels at speed
+# (negative backward) and bring each sensor onto the near edge of the
+# line on its own wheel, so the robot ends at right angles to the line.
+# When heading is given the gyro is reset to it. Returns False if the
+# line wasn't found within timeout_ms.
+async def square_to_line(speed=LINE_SQUARE_SPEED, heading=None, timeout_ms=DRIVE_TIMEOUT_MS):
+    timeout = Elapsed(timeout_ms)
+    snapshot = Snapshot((LINE_SENSOR_LEFT, LINE_SENSOR_RIGHT))
+    loop = ControlLoop()
+    sample_log.new_segment()
+    current_heading = heading_tracker.update()
+    travel = pose.update(current_heading)
+    snapshot.update(current_heading, travel)
+    timeout.start(snapshot)
+    squared = False
+    while not timeout.met(snapshot):
+        left_speed = square_speed(speed, line_level(LINE_SENSOR_LEFT, snapshot.reflection[LINE_SENSOR_LEFT]))
+        right_speed = square_speed(speed, line_level(LINE_SENSOR_RIGHT, snapshot.reflection[LINE_SENSOR_RIGHT]))
+        if left_speed == 0 and right_speed == 0:
+            squared = True
+            break
+        motor_pair.move_tank(motor_pair.PAIR_1, left_speed, right_speed, acceleration=TURN_ACCELERATION)
+        if LOG_SAMPLES:
+            sample_log.append(current_heading, int(travel), 0, left_speed)
+        await loop.tick()
+        current_heading = heading_tracker.update()
+        travel = pose.update(current_heading)
+        snapshot.update(current_heading, travel)
+    motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
+    if squared and heading is not None:
+        rezero_heading(heading)
+    return squared
+
+
+# From a stop on a line, drive DISTANCE_CALIBRATION_CROSS cm on over it
+# in direction (1 forward, -1 backward) and square on it again from the
+# other side.
+async def recross_line(direction):
+    await follow_gyro_angle(speed=direction * LINE_SQUARE_SPEED, target_angle=0,
+                            until=Distance(degrees_for_distance(DISTANCE_CALIBRATION_CROSS)))
+    return await square_to_line(-direction * LINE_SQUARE_SPEED, heading=0)
+
+
+# One calibration leg: from a squared stop on a line, drive degrees in
+# direction at speed, square on the next line and step over it for the
+# leg back. Returns (drive, leg) in encoder degrees, the drive alone and
+# the drive plus the creep onto the line, or None if the line was lost.
+async def calibration_leg(direction, speed, degrees):
+    start_travel = pose.update(heading_tracker.update())
+    await follow_gyro_angle(speed=direction * speed, target_angle=0,
+                            until=Travel(start_travel + direction * degrees, direction),
+                            profile_distance=degrees)
+    # let HOLD settle before reading where the drive ended
+    await runloop.sleep_ms(TURN_LATENCY_MS * 5)
+    end_travel = pose.update(heading_tracker.update())
+    squared = await square_to_line(direction * LINE_SQUARE_SPEED, heading=0)
+    stop_travel = pose.update(heading_tracker.update())
+    if not squared or not await recross_line(direction):
+        print("Distance calibration failed: lost the line at {} deg/s".format(direction * speed))
+        light.color(light.POWER, color.RED)
+        return None
+    return (end_travel - start_travel) * direction, (stop_travel - start_travel) * direction
+
+
+# Calibrate distances: place the robot square between two lines across
+# its path, DISTANCE_CALIBRATION_PITCH cm apart, with the line sensors
+# over the mat. It squares on the first line from behind, then drives to
+# the other line and back at every calibration speed; each drive stops
+# short and squares on the line ahead. Squaring stops anywhere within
+# LINE_SQUARE_TOLERANCE of the edge on the side it comes from, so every
+# drive starts from a stop made from the same side as the one it ends
+# on (steps over the line in between) and the two offsets cancel: drive
+# and creep together cover one pitch. The creep is slow and slips less
+# than a fast drive, so it is measured on its own first: legs driven all
+# the way at LINE_SQUARE_SPEED, where drive and creep slip alike, give
+# real cm per encoder cm at creep speed. Runs on its own (see the slots
+# at the end); the new table is used from the next program start.
+async def calibrate_distances():
+    motor_pair.pair(motor_pair.PAIR_1, port.A, port.E)
+    await do_init()
+    if not await square_to_line(-LINE_SQUARE_SPEED, heading=0) or not await recross_line(-1):
+        print("Distance calibration failed: no line behind the robot")
+        light.color(light.POWER, color.RED)
+        return False
+    commanded = DISTANCE_CALIBRATION_PITCH - DISTANCE_CALIBRATION_SHORT
+    degrees = degrees_for_distance(commanded)
+    # real cm per encoder cm while creeping, per direction
+    creep_scale = {1: 0.0, -1: 0.0}
+    for _ in range(DISTANCE_CALIBRATION_TRIALS):
+        for direction in (1, -1):
+            measured = await calibration_leg(direction, LINE_SQUARE_SPEED, degrees)
+            if measured is None:
+                return False
+            creep_scale[direction] += (DISTANCE_CALIBRATION_PITCH / (measured[1] * WHEEL_CIRCUMFERENCE / 360)
+                                       / DISTANCE_CALIBRATION_TRIALS)
+    # sum of real/commanded and number of drives per (direction, speed)
+    totals = {}
+    for _ in range(DISTANCE_CALIBRATION_TRIALS):
+        for speed in DISTANCE_CALIBRATION_SPEEDS:
+            for direction in (1, -1):
+                measured = await calibration_leg(direction, speed, degrees)
+                if measured is None:
+                    return False
+                drive, leg = measured
+                # the leg was one pitch; take off what the creep really covered
+                creep = (leg - drive) * WHEEL_CIRCUMFERENCE / 360 * creep_scale[direction]
+                real = DISTANCE_CALIBRATION_PITCH - creep
+                total = totals.get((direction, speed), (0.0, 0))
+                totals[(direction, speed)] = (total[0] + real / commanded, total[1] + 1)
+    with open(DISTANCE_CALIBRATION_FILE, "w") as calibration_file:
+        for direction, name in ((1, "DISTANCE_SCALE_FORWARD"), (-1, "DISTANCE_SCALE_REVERSE")):
+            rows = []
+            for speed in DISTANCE_CALIBRATION_SPEEDS:
+                total = totals[(direction, speed)]
+                rows.append((speed, round(total[0] / total[1], 4)))
+                calibration_file.write("{} {} {}\n".format(direction, speed, rows[-1][1]))
+            distance_calibration[direction] = tuple(rows)
+            # to keep as the default in CONSTANTS
+            print(name + " = (")
+            for row in rows:
+                print("    ({}, {}),".format(row[0], row[1]))
+            print(")")
+    light.color(light.POWER, color.GREEN)
+    return True
+
+
+# ATTACHMENTS
+#----------------------------------------
+# One command queue per attachment port. queue() hands back an ArmCommand
+# right away and the port's worker runs its commands one after the
+# other, in parallel with the drive, so a move never cuts off the one
+# before it on the same motor. Await a command (or idle() for the whole
+# port) only where the run depends on the move having finished.
+
+class ArmCommand:
+
+    def __init__(self, degrees, speed, acceleration=0, start_travel=0, distance=0):
+        self.degrees = degrees
+        self.speed = speed
+        self.acceleration = acceleration
+        # hold the move until pose.travel is distance encoder degrees past
+        # start_travel, or until released (the drive it rides on ended short)
+        self.start_travel = start_travel
+        self.distance = distance
+        self.released = False
+        self.done = False
+        # ended early because the mechanism bottomed out or jammed
+        self.stalled = False
+        # time.ticks_us() when the motor started and when it finished, for
+        # the step report
+        self.start_us = 0
+        self.done_us = 0
+
+    async def wait(self):
+        if not self.done:
+            await runloop.until(lambda: self.done)
+
+
+class Attachments:
+
+    def __init__(self, ports):
+        self.queues = {}
+        for motor_port in ports:
+            self.queues[motor_port] = []
+        self.closed = True
+
+    def queue(self, motor_port, degrees, speed, acceleration=0, start_travel=0, distance=0):
+        command = ArmCommand(degrees, speed, acceleration, start_travel, distance)
+        self.queues[motor_port].append(command)
+        return command
+
+    async def idle(self, motor_port):
+        # wait for every move queued on motor_port so far
+        queue = self.queues[motor_port]
+        if queue:
+            await queue[-1].wait()
+
+    async def worker(self, motor_port):
+        queue = self.queues[motor_port]
+        while True:
+            await runloop.until(lambda: len(queue) > 0 or self.closed)
+            if not queue:
+                return
+            command = queue[0]
+            if command.distance:
+                await runloop.until(lambda: command.released or self.closed
+                                    or abs(pose.travel - command.start_travel) >= command.distance)
+            command.start_us = time.ticks_us()
+            speed = battery.limit(command.speed)
+            target = degrees_target(motor.relative_position(motor_port), command.degrees, speed)
+            if command.acceleration:
+                move = motor.run_for_degrees(motor_port, command.degrees, speed,
+                                             acceleration=command.acceleration)
+            else:
+                move = motor.run_for_degrees(motor_port, command.degrees, speed)
+            command.stalled = await run_until_stalled(move, lambda: motor.relative_position(motor_port), target,
+                                                      lambda: motor.stop(motor_port))
+            command.done_us = time.ticks_us()
+            command.done = True
+            queue.pop(0)
+
+    async def run(self, coroutine):
+        # run coroutine with a worker per port, until it and every move it queued are done.
+        # Inside another run (a path driven from a run), the workers already
+        # there take its moves: a second set would take the same commands
+        if not self.closed:
+            await coroutine
+            return
+        self.closed = False
+        async def main():
+            try:
+                await coroutine
+            finally:
+                self.closed = True
+        await runloop.gather(main(), *[self.worker(motor_port) for motor_port in self.queues])
+
+
+attachments = Attachments((port.B, port.C))
+
+
+# MISSION STEPS
+#----------------------------------------
+# Runs are tables of steps, one tuple per step, executed by run_steps.
+# Distances are in cm and converted to encoder degrees once at load by
+# compile_steps, corrected for the step's speed (see distance_scale).
+
+# gyro drive: (DRIVE, speed, target_angle, distance_cm[, kp]), gains come
+# from the gain schedule unless kp is given (ki and kd are then 0),
+# compiled to (DRIVE, speed, target_angle, degrees, kp, start_speed, end_speed)
+DRIVE = 0
+# gyro pivot turn, stops with HOLD: (TURN, left_speed, right_speed, angle[, precise]),
+# precise=False turns at full speed until the target is crossed
+TURN = 1
+# spin right until yaw angle (0-360): (TURN_RIGHT, angle)
+TURN_RIGHT = 2
+# straight move_for_degrees without gyro, ends early on contact: (MOVE, velocity, distance_cm)
+MOVE = 3
+# queue attachment move and keep going: (ARM, port, degrees, speed[, acceleration]),
+# moves on the same port run in order
+ARM = 4
+# queue attachment move and wait for it: (ARM_WAIT, port, degrees, speed[, acceleration])
+ARM_WAIT = 5
+# attachment move during the next DRIVE, once it has covered distance_cm:
+# (ARM_AFTER, port, degrees, speed, distance_cm)
+ARM_AFTER = 6
+# wait: (SLEEP, ms)
+SLEEP = 7
+# wait for every attachment move queued on a port so far: (ARM_DONE, port)
+ARM_DONE = 8
+# MOVE into a model that is square to heading and, if the robot stops
+# against it, reset the gyro to heading: (SQUARE, velocity, distance_cm, heading)
+SQUARE = 9
+# gyro arc on both wheels until the heading reaches angle, instead of a
+# stop-pivot-stop corner: (ARC, speed, radius_cm, angle[, stop]), radius
+# positive curves right, negative left
+ARC = 10
+# follow the edge of a line for distance_cm: (LINE, speed, sensor_port,
+# distance_cm[, side]), side 1 (default) keeps the line left of the sensor
+LINE = 11
+# square up on a line across the path and reset the gyro to heading:
+# (SQUARE_LINE, speed, heading)
+SQUARE_LINE = 12
+
+OP_NAMES = ("DRIVE", "TURN", "TURN_RIGHT", "MOVE", "ARM", "ARM_WAIT", "ARM_AFTER", "SLEEP", "ARM_DONE", "SQUARE",
+            "ARC", "LINE", "SQUARE_LINE")
+
+# time every step and print a per-run breakdown at the end of execute,
+# optionally also as CSV for off-robot analysis
+PROFILE_STEPS = True
+PRINT_STEP_CSV = False
+
+# (run_number, step_index, start_us, duration_us) for every step executed
+step_times = []
+# (run_number, step_index, ArmCommand) for every attachment move queued,
+# read for its start and done times once the run is over
+arm_times = []
+
+
+def compile_steps(steps):
+    compiled = []
+    for step in steps:
+        op = step[0]
+        if op == DRIVE:
+            speed = step[1]
+            kp = step[4] if len(step) > 4 else None
+            # kp is -ve for forward movement and +ve for backward movement
+            if kp is not None and speed > 0: kp = -kp
+            compiled.append([DRIVE, speed, step[2], degrees_for_distance(step[3], speed), kp,
+                             DRIVE_MIN_SPEED, DRIVE_MIN_SPEED])
+        elif op == MOVE or op == SQUARE:
+            compiled.append((op, step[1], degrees_for_distance(step[2], step[1])) + step[3:])
+        elif op == ARM_AFTER:
+            compiled.append(step[:4] + (degrees_for_distance(step[4]),))
+        elif op == LINE:
+            compiled.append(step[:3] + (degrees_for_distance(step[3], step[1]),) + step[4:])
+        else:
+            compiled.append(step)
+
+    if BLEND_SEGMENTS:
+        # plan the speed each drive hands off to the step after it;
+        # end_speed 0 marks a drive that stops with HOLD
+        for i, step in enumerate(compiled):
+            if step[0] != DRIVE:
+                continue
+            step[6] = 0
+            following = compiled[i + 1] if i + 1 < len(compiled) else None
+            if following is None:
+                continue
+            if (following[0] == DRIVE and (following[1] > 0) == (step[1] > 0)
+                    and abs(wrap_angle(following[2] - step[2])) <= BLEND_MAX_HEADING_CHANGE):
+                carry = min(abs(step[1]), abs(following[1]))
+                step[6] = carry
+                following[5] = carry
+            elif following[0] == TURN and (following[4] if len(following) > 4 else True):
+                # roll into the pivot at the landing speed, skipping the
+                # HOLD; a precise pivot sheds it at TURN_ACCELERATION (a
+                # quick one accelerates too gently to, so it gets the HOLD)
+                step[6] = min(abs(step[1]), DRIVE_MIN_SPEED)
+    return tuple(tuple(step) if isinstance(step, list) else step for step in compiled)
+
+
+PORT_NAMES = "ABCDEF"
+
+
+def step_cm(degrees):
+    return round(degrees * WHEEL_CIRCUMFERENCE / 360, 1)
+
+
+def describe_step(step):
+    # the step as written in its table: ports by letter, distances in cm
+    op = step[0]
+    if op == DRIVE:
+        values = (step[1], step[2], step_cm(step[3]))
+    elif op == MOVE or op == SQUARE:
+        values = (step[1], step_cm(step[2])) + step[3:]
+    elif op == ARM or op == ARM_WAIT or op == ARM_DONE:
+        values = (PORT_NAMES[step[1]],) + step[2:4]
+    elif op == ARM_AFTER:
+        values = (PORT_NAMES[step[1]], step[2], step[3], step_cm(step[4]))
+    elif op == LINE:
+        values = (step[1], PORT_NAMES[step[2]], step_cm(step[3])) + step[4:]
+    else:
+        values = step[1:]
+    return OP_NAMES[op] + " " + " ".join(str(value) for value in values)
+
+
+def arm_motion_us(run_number, index):
+    # how long the attachment moves queued by a step ran, 0 if none did
+    total_us = 0
+    for arm_run, arm_index, command in arm_times:
+        if arm_run == run_number and arm_index == index and command.done_us:
+            total_us += time.ticks_diff(command.done_us, command.start_us)
+    return total_us
+
+
+def print_step_report(run_number, steps):
+    # slowest steps first, then time spent per step type. A step's time is
+    # how long it held up the run (for ARM_WAIT and ARM_DONE: blocked on
+    # the arm); arm is how long the moves it queued ran next to the steps
+    times = [t for t in step_times if t[0] == run_number]
+    if not times:
+        return
+    print("Run " + str(run_number) + " steps:")
+    op_totals = [0] * len(OP_NAMES)
+    arm_total_us = 0
+    for _, index, start_us, duration_us in sorted(times, key=lambda t: -t[3]):
+        op_totals[steps[index][0]] += duration_us
+        line = "  {:7.3f} s  #{:<3} {}".format(duration_us / 1000000, index, describe_step(steps[index]))
+        if steps[index][0] in (ARM, ARM_WAIT, ARM_AFTER):
+            motion_us = arm_motion_us(run_number, index)
+            arm_total_us += motion_us
+            line += "  (arm {:.3f} s)".format(motion_us / 1000000)
+        print(line)
+    for op, total_us in enumerate(op_totals):
+        if total_us:
+            print("  {:7.3f} s  total {}".format(total_us / 1000000, OP_NAMES[op]))
+    print("  {:7.3f} s  blocked on arms (ARM_WAIT + ARM_DONE), arms moved {:.3f} s".format(
+        (op_totals[ARM_WAIT] + op_totals[ARM_DONE]) / 1000000, arm_total_us / 1000000))
+
+
+def print_step_csv(run_steps_map):
+    print("run,step,label,start_ms,duration_ms,arm_ms")
+    for run_number, index, start_us, duration_us in step_times:
+        print("{},{},{},{},{},{}".format(run_number, index, describe_step(run_steps_map[run_number][index]),
+                                         start_us // 1000, duration_us / 1000, arm_motion_us(run_number, index) / 1000))
+
+
+async def run_steps(steps, run_number=0):
+    # attachment moves run next to the steps; done once both are
+    await attachments.run(step_through(steps, run_number))
+
+
+async def step_through(steps, run_number=0):
+    arm_after = None
+    arm_after_index = 0
+    # how far (pose travel) the last drive ended past its target, and its
+    # heading: the next drive takes the part along its own heading off its
+    # distance, so errors don't pile up over a run
+    carry_error = 0.0
+    carry_heading = 0
+    for index, step in enumerate(steps):
+        started = time.ticks_us()
+        battery.sample()
+        op = step[0]
+        if op == DRIVE:
+            direction = 1 if step[1] > 0 else -1
+            start_travel = pose.update(heading_tracker.update())
+            offset = carry_error * math.cos(math.radians(step[2] - carry_heading))
+            distance = step[3] - offset * direction
+            if distance < 0: distance = 0
+            target_travel = start_travel + direction * distance
+            end_speed = step[6] if BLEND_SEGMENTS else DRIVE_MIN_SPEED
+            stop = not BLEND_SEGMENTS or end_speed == 0
+            drive = follow_gyro_angle(speed=step[1], target_angle=step[2], until=Travel(target_travel, direction),
+                        kp=step[4], profile_distance=distance, start_speed=step[5],
+                        end_speed=end_speed if end_speed else DRIVE_MIN_SPEED, stop=stop)
+            arm = None
+            if arm_after:
+                arm = attachments.queue(arm_after[1], arm_after[2], arm_after[3], start_travel=start_travel,
+                                        distance=arm_after[4])
+                if PROFILE_STEPS:
+                    arm_times.append((run_number, arm_after_index, arm))
+                arm_after = None
+            await drive
+            if arm:
+                # a drive that stalled or timed out short of the distance
+                # would hold the move forever: make it where the robot is
+                arm.released = True
+            carry_error = pose.update(heading_tracker.update()) - target_travel
+            carry_heading = step[2]
+            # blocked short of the target: that's the model, not drive error
+            if carry_error * direction < -STALL_MIN_REMAINING:
+                carry_error = 0.0
+        elif op == TURN:
+            await pivot_gyro_turn_abs(left_speed=step[1], right_speed=step[2], angle=step[3], stop=True,
+                                      precise=step[4] if len(step) > 4 else True)
+        elif op == TURN_RIGHT:
+            await turnRight(step[1])
+        elif op == ARC:
+            await arc_gyro_turn(step[1], step[2], angle=step[3], stop=step[4] if len(step) > 4 else True)
+            # the arc has no encoder target to carry an error from
+            carry_error = 0.0
+        elif op == LINE:
+            await follow_line(step[1], step[2], Distance(step[3]), side=step[4] if len(step) > 4 else 1)
+            carry_error = 0.0
+        elif op == SQUARE_LINE:
+            await square_to_line(step[1], heading=step[2])
+            # the next drive starts from the line
+            carry_error = 0.0
+        elif op == MOVE or op == SQUARE:
+            start_travel = pose.update(heading_tracker.update())
+            move = motor_pair.move_for_degrees(motor_pair.PAIR_1, step[2], 0, velocity=battery.limit(step[1]))
+            stalled = await run_until_stalled(move, lambda: pose.update(heading_tracker.update()),
+                                              degrees_target(start_travel, step[2], step[1]),
+                                              lambda: motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD))
+            if op == SQUARE and stalled:
+                rezero_heading(step[3])
+            # pushes and pulls end where the model stops them, don't carry that
+            pose.update(heading_tracker.update())
+            carry_error = 0.0
+        elif op == ARM or op == ARM_WAIT:
+            arm = attachments.queue(step[1], step[2], step[3], step[4] if len(step) > 4 else 0)
+            if PROFILE_STEPS:
+                arm_times.append((run_number, index, arm))
+            if op == ARM_WAIT:
+                await arm.wait()
+        elif op == ARM_AFTER:
+            arm_after = step
+            arm_after_index = index
+        elif op == SLEEP:
+            await runloop.sleep_ms(step[1])
+        elif op == ARM_DONE:
+            await attachments.idle(step[1])
+        if PROFILE_STEPS:
+            step_times.append((run_number, index, started, time.ticks_diff(time.ticks_us(), started)))
+
+# WAYPOINTS
+#----------------------------------------
+# Paths on field coordinates in cm: x forward from where the robot
+# starts the run (do_init resets the pose), y to its right. Each leg
+# becomes a TURN and a DRIVE step for run_steps.
+
+def merge_collinear(points):
+    # drop waypoints that sit on a straight line between their neighbours
+    merged = []
+    for point in points:
+        if len(merged) >= 2:
+            a, b = merged[-2], merged[-1]
+            first = math.atan2(b[1] - a[1], b[0] - a[0])
+            second = math.atan2(point[1] - b[1], point[0] - b[0])
+            if abs(wrap_angle(math.degrees(second - first))) <= PATH_COLLINEAR_TOLERANCE:
+                merged[-1] = point
+                continue
+        merged.append(point)
+    return merged
+
+
+def plan_path(waypoints, x, y, heading, speed):
+    # steps that take the robot from (x, y, heading) through waypoints,
+    # turning the shorter way and driving backward whenever that turns less
+    steps = []
+    points = merge_collinear([(x, y)] + list(waypoints))
+    for i in range(1, len(points)):
+        dx = points[i][0] - points[i - 1][0]
+        dy = points[i][1] - points[i - 1][1]
+        distance = math.sqrt(dx * dx + dy * dy)
+        if distance < 0.5:
+            continue
+        leg = math.degrees(math.atan2(dy, dx))
+        leg_speed = abs(speed)
+        if abs(wrap_angle(leg - heading)) > 90:
+            leg = wrap_angle(leg + 180)
+            leg_speed = -leg_speed
+        turn = wrap_angle(leg - heading)
+        if abs(turn) > PATH_TURN_TOLERANCE:
+            turn_speed = PATH_TURN_SPEED if turn > 0 else -PATH_TURN_SPEED
+            steps.append((TURN, turn_speed, -turn_speed, leg))
+        steps.append((DRIVE, leg_speed, leg, distance))
+        heading = leg
+    return compile_steps(steps)
+
+
+async def path(waypoints, speed=600):
+    heading = heading_tracker.update()
+    pose.update(heading)
+    await run_steps(plan_path(waypoints, pose.x, pose.y, wrap_angle(heading), speed))
+
+
+async def drive_to(x, y, speed=600):
+    await path(((x, y),), speed)
+
+# END WAYPOINTS
+#----------------------------------------
+
+# END MISSION STEPS
+#----------------------------------------
+
+
 def get_time_taken_in_seconds(start_time, end_time):
     return int(time.ticks_diff(end_time, start_time)/1000)
 
+
+def battery_summary(start_voltage, end_voltage):
+    # battery at the start and end of a run, to print next to its time
+    return ", battery {:.2f} V -> {:.2f} V".format(start_voltage / 1000, end_voltage / 1000)
+
 # END UTILITY FUNCTIONS
 #----------------------------------------
 
@@ -142,181 +1834,130 @@ def get_time_taken_in_seconds(start_time, end_time):
 #----------------------------------------
 
 # run 1 program
-async def run1():
-
+RUN1 = compile_steps((
     # go backward to get out of base
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-500, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(3)))
+    (DRIVE, -500, 0, 3),
 
     # turn left to get in alignment with krill
-    await pivot_gyro_turn_abs(left_speed=-200, right_speed=200, angle=-45, stop=True)
+    (TURN, -300, 300, -45),
 
     # go backward to collect krill
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-600, target_angle=-45, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(16)))
+    (DRIVE, -600, -45, 16),
 
     # turn right to get in alignment with coral piece
-    await pivot_gyro_turn_abs(left_speed=200, right_speed=-200, angle=0, stop=True)
+    (TURN, 300, -300, 0),
 
     # go backward to collect coral piece
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-600, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(35)))
+    (DRIVE, -600, 0, 35),
 
     # go forward to leave pieces for shipping lanes
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=600, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(17)))
+    (DRIVE, 600, 0, 17),
 
     # turn right to get in alignment with changing shipping lanes
-    await pivot_gyro_turn_abs(left_speed=150, right_speed=-150, angle=45, stop=True)
+    (TURN, 300, -300, 45),
 
     # go backward to engage with shipping lanes
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-400, target_angle=45, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(16)))
+    (DRIVE, -400, 45, 16),
 
     # raise shipping lane/seabed attachment to lift shipping lanes
-    await motor.run_for_degrees(port.C, 1000, 1100)
+    (ARM_WAIT, port.C, 1000, 1100),
 
     # turn right to drop shipping lanes on other side
-    await pivot_gyro_turn_abs(left_speed=125, right_speed=-125, angle=100, stop=True)
+    (TURN, 300, -300, 100),
 
     # go forward to leave shipping lanes
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=400, target_angle=100, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(12.5)))
+    (DRIVE, 400, 100, 12.5),
 
     # turn left to get back into alignment with krill/coral pieces
-    await pivot_gyro_turn_abs(left_speed=-150, right_speed=150, angle=4, stop=True)
+    (TURN, -300, 300, 4),
 
     # reset shipping lanes attachment to get ready for sample collection
-    motor.run_for_degrees(port.C, -500, 900)
+    (ARM, port.C, -500, 900),
 
     # go backward to recollect pieces
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-600, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(18)))
+    (DRIVE, -600, 0, 18),
 
     # turn right to align with last krill
-    await pivot_gyro_turn_abs(left_speed=200, right_speed=-200, angle=45, stop=True)
+    (TURN, 300, -300, 45),
 
     # go backward to collect last krill
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-400, target_angle=45, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(5.5)))
+    (DRIVE, -400, 45, 5.5),
 
     # turn to align with plankton hook
-    # await pivot_gyro_turn_abs(left_speed=200, right_speed=-200, angle=165, stop=True)
-    await pivot_gyro_turn_abs(left_speed=-125, right_speed=125, angle=-87, stop=True)
+    # (TURN, 200, -200, 165),
+    (TURN, -300, 300, -87),
 
     # go forward to hook into plankton
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(12),0,velocity=300)
+    (MOVE, 300, 12),
 
     # go backward to pull plankton
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(2),0,velocity=-300)
+    (MOVE, -300, 2),
 
     # go forward to get away from sonar discovery
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-500, target_angle=-88, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(5)))
+    (DRIVE, -500, -88, 5),
 
     # turn right to go forward
-    await pivot_gyro_turn_abs(left_speed=-150, right_speed=150, angle=-91, stop=True)
+    (TURN, -300, 300, -91),
 
     # go backward toward seabed
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-1000, target_angle=-91, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(19)))
+    (DRIVE, -1000, -91, 19),
 
     # go backward toward seabed
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-1000, target_angle=-90, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(77)))
+    (DRIVE, -1000, -90, 77),
 
     # bring send over the submersible attachment down
-    motor.run_for_degrees(port.B, 2500, 1100)
+    (ARM, port.B, 2500, 1100),
 
     # go forward (back) to leave pieces
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=500, target_angle=-94, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(16)))
+    (DRIVE, 500, -94, 16),
 
     # turn to align to seabed sample
-    await pivot_gyro_turn_abs(left_speed=300, right_speed=-300, angle=0, stop=True)
-    await turnRight(8)
+    (TURN, 300, -300, 8),
 
     # go forward to engage with seabed sample
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(17),0,velocity=-400)
+    (MOVE, -400, 17),
 
     # raise seabed sample hook to raise the sample and collect it
     # raise send over the submersible attachment
-    motor.run_for_degrees(port.C, 1000, 900)
-    await motor.run_for_degrees(port.B, 1300, -1000)
-    await runloop.sleep_ms(500)
-    motor.run_for_degrees(port.C, 700, 900)
+    (ARM, port.C, 1000, 900),
+    (ARM_WAIT, port.B, 1300, -1000),
+    (SLEEP, 500),
+    (ARM, port.C, 700, 900),
 
     # come back from seabed
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=400, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-            initial_position=initial_position, distance_to_cover=(degrees_for_distance(10)))
+    (DRIVE, 400, 0, 10),
 
     # turn to leave seabed sample
-    await pivot_gyro_turn_abs(left_speed=-200, right_speed=200, angle=-93, stop=True)
+    (TURN, -300, 300, -93),
 
     # go forward to recollect samples
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-700, target_angle=-93, sleep_time=0, follow_for=follow_for_distance,
-    initial_position=initial_position, distance_to_cover=(degrees_for_distance(19)))
+    (DRIVE, -700, -93, 19),
 
     # turn left to align with water sample/krill
-    await pivot_gyro_turn_abs(left_speed=-200, right_speed=200, angle=-101, stop=True)
+    (TURN, -300, 300, -101),
 
     # go forward to collect water sample and krill
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-500, target_angle=-101, sleep_time=0, follow_for=follow_for_distance,
-    initial_position=initial_position, distance_to_cover=(degrees_for_distance(16)))
+    (DRIVE, -500, -101, 16),
 
     # turn left collect coral piece
-    await pivot_gyro_turn_abs(left_speed=-200, right_speed=200, angle=-108, stop=True)
+    (TURN, -300, 300, -108),
 
     # go backward to collect coral piece
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-400, target_angle=-108, sleep_time=0, follow_for=follow_for_distance,
-    initial_position=initial_position, distance_to_cover=(degrees_for_distance(16)))
+    (DRIVE, -400, -108, 16),
 
     # turn left to collect last coral piece
-    await pivot_gyro_turn_abs(left_speed=-200, right_speed=200, angle=-170, stop=True)
+    (TURN, -300, 300, -170),
 
     # go forward to collect last coral piece
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-1100, target_angle=-170, sleep_time=0, follow_for=follow_for_distance,
-    initial_position=initial_position, distance_to_cover=(degrees_for_distance(30)))
+    (DRIVE, -1100, -170, 30),
 
     # go forward to get into base
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-1100, target_angle=-140, sleep_time=0, follow_for=follow_for_distance,
-    initial_position=initial_position, distance_to_cover=(degrees_for_distance(45)))
+    (DRIVE, -1100, -140, 45),
+))
+
+
+async def run1():
+    await run_steps(RUN1, 1)
 
 # END RUN 1
 #----------------------------------------
@@ -324,145 +1965,124 @@ async def run1():
 # RUN 2
 #----------------------------------------
 # run 2 program - Raise the mast, Kraken's treasure, Diver Pickup, Diver Drop off, Coral buds, Coral Reef Buds, Shark Pick up, Coral Tree
-async def run2():
-
+RUN2 = compile_steps((
     # go straight to get out of base
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=600, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(15)))
+    (DRIVE, 600, 0, 15),
 
     # turn left to get out of base
-    await pivot_gyro_turn_abs(left_speed=-250, right_speed=250, angle=-145, stop=True)
+    (TURN, -300, 300, -145),
 
     # go straight (backward) to align with shipwreck
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-650, target_angle=-145, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(37)))
+    (DRIVE, -650, -145, 37),
 
     # turn right to get in front of shipwreck
-    await pivot_gyro_turn_abs(left_speed=100, right_speed=-100, angle=-90, stop=True)
+    (TURN, 300, -300, -90),
 
     # go straight to engage with shipwreck
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-350, target_angle=-90, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(24.5)))
+    (DRIVE, -350, -90, 24.5),
 
     # lower fork arm to get in position to pick up diver
-    motor.run_for_degrees(port.C, -500, 1100)
+    (ARM, port.C, -500, 1100),
 
     # come back to collect treasure and release mast
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=450, target_angle=-90, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(23)))
+    (DRIVE, 450, -90, 23),
 
     # turn left to prepare for alignment with coral tree
-    await pivot_gyro_turn_abs(left_speed=-100, right_speed=100, angle=-145, stop=True)
+    (TURN, -300, 300, -145),
 
     # lower fork arm to get in position to pick up diver
-    motor.run_for_degrees(port.C, -515, 1100)
+    (ARM, port.C, -515, 1100),
 
     # go forward to prepare for alignment with coral tree
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-500, target_angle=-145, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(13)))
+    (DRIVE, -500, -145, 13),
 
     # turn right to get in alignment with coral tree
-    await pivot_gyro_turn_abs(left_speed=100, right_speed=-100, angle=-89, stop=True)
+    (TURN, 300, -300, -89),
 
     # lower coral tree arm to get in postion to lift coral tree
-    motor.run_for_degrees(port.B, 175, 250)
+    (ARM, port.B, 175, 250),
 
     # lower fork arm to get in position to pick up diver
-    await motor.run_for_degrees(port.C, -1100, 1100)
+    (ARM_WAIT, port.C, -1100, 1100),
 
     # go straight to push coral tree buds
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(14), 0, velocity=200)
+    (MOVE, 200, 14),
 
     # lift coral tree arm to complete coral tree mission
-    await motor.run_for_degrees(port.B, -75, 150)
-    await motor.run_for_degrees(port.B, -100, 300)
+    (ARM_WAIT, port.B, -75, 150),
+    (ARM_WAIT, port.B, -100, 300),
 
     # raise fork arm to pick up diver
-    await motor.run_for_degrees(port.C, 400, 500)
+    (ARM_WAIT, port.C, 400, 500),
 
     # bring coral tree arm down
-    await motor.run_for_degrees(port.B, 175, 250)
+    (ARM_WAIT, port.B, 175, 250),
 
     # raise fork arm to pick up diver (2)
-    motor.run_for_degrees(port.C, 800, 1100)
+    (ARM, port.C, 800, 1100),
 
     # come back from coral tree to get in alignment with Scuba Diver
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-500, target_angle=-90, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(8)))
+    (DRIVE, -500, -90, 8),
 
     # bring coral tree arm up
-    await motor.run_for_degrees(port.B, -175, 200)
+    (ARM_WAIT, port.B, -175, 200),
 
     # turn right to get in alignment with scuba diver
-    await pivot_gyro_turn_abs(left_speed=150, right_speed=-150, angle=0, stop=True)
-    await pivot_gyro_turn_abs(left_speed=150, right_speed=-150, angle=13, stop=True)
+    (TURN, 300, -300, 13),
 
     # come back to get in alignment with scuba diver
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-400, target_angle=13, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(5.5)))
+    (DRIVE, -400, 13, 5.5),
 
     # put fork down to drop off Scuba Diver
-    await motor.run_for_degrees(port.C, -925, 1100)
+    (ARM_WAIT, port.C, -925, 1100),
 
     # go forward towards scuba diver drop off
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(10), 0, velocity=200)
+    (MOVE, 200, 10),
 
     # move fork down to fully release Scuba Diver
-    await motor.run_for_degrees(port.C, -325, 1100)
+    (ARM_WAIT, port.C, -325, 1100),
 
     # come back and get ready to align with coral reef buds
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-400, target_angle=12, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(8)))
+    (DRIVE, -400, 12, 8),
 
     # turn left to get in alignment with coral reef buds
-    await pivot_gyro_turn_abs(left_speed=-150, right_speed=150, angle=6, stop=True)
+    (TURN, -300, 300, 6),
 
     # raise fork arm so coral reef hook can engage with yellow lever
-    await motor.run_for_degrees(port.C, 150, 1100)
+    (ARM_WAIT, port.C, 150, 1100),
 
     # go forward to complete coral reef buds mission
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(12.5), 0, velocity=200)
+    (MOVE, 200, 12.5),
 
     # lower Shark Hook to push the shark misson lever
-    motor.run_for_degrees(port.B, 200, 600)
+    (ARM, port.B, 200, 600),
 
     # lower fork arm to ensure that the coral buds are pushed down
-    await motor.run_for_degrees(port.C, -875, 1100)
+    (ARM_WAIT, port.C, -875, 1100),
 
     # raise Shark Hook so it does not interfere with any other missions
-    await motor.run_for_degrees(port.B, -200, 200)
+    (ARM_WAIT, port.B, -200, 200),
 
     # raise fork arm to make sure that it doesen't get stuck when we come back
-    await motor.run_for_degrees(port.C, 775, 1100)
-    motor.run_for_degrees(port.C, 995, 1100)
+    (ARM_WAIT, port.C, 775, 1100),
+    (ARM, port.C, 995, 1100),
 
     # come back a bit to get to base
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(53), 0, velocity=-1100)
+    (MOVE, -1100, 53),
 
     # raise fork arm to ensurre it isn't out of base
-    motor.run_for_degrees(port.C, 1400, 1100)
+    (ARM, port.C, 1400, 1100),
 
     # turn right to get fully in to base
-    await pivot_gyro_turn_abs(left_speed=150, right_speed=-150, angle=69, stop=True)
+    (TURN, 300, -300, 69),
 
     # come back to get to base
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(50), 0, velocity=-1100)
+    (MOVE, -1100, 50),
+))
+
+
+async def run2():
+    await run_steps(RUN2, 2)
 
 # END RUN 2
 #----------------------------------------
@@ -470,89 +2090,67 @@ async def run2():
 # RUN 3
 #----------------------------------------
 # run 3 program
-async def run3():
-
+RUN3 = compile_steps((
     # turn to get ready to align with krill pick up
-    await pivot_gyro_turn_abs(left_speed=225, right_speed=0, angle=58, stop=True)
+    (TURN, 225, 0, 58),
 
     # bring arm down (1) to save time
-    motor.run_for_degrees(port.C, 1200, 1000)
+    (ARM, port.C, 1200, 1000),
 
     # move forward to get ready to align with krill pick up
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=600, target_angle=58, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(48)))
+    (DRIVE, 600, 58, 48),
 
     # turn to align to pick up of krill
-    await pivot_gyro_turn_abs(left_speed=0, right_speed=70, angle=57, stop=True)
+    (TURN, 0, 70, 57),
 
     # move forward to align with the shark drop off and krill pick up
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(18.5), 0, velocity=300)
+    (MOVE, 300, 18.5),
 
     # move trident hook to latch on to trident
-    await motor.run_for_degrees(port.B, 300, -600)
+    (ARM_WAIT, port.B, 300, -600),
 
     # move back to drop off shark
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(23.5), 0, velocity=-400)
+    (MOVE, -400, 23.5),
 
     # turn to align with ship
-    await pivot_gyro_turn_abs(left_speed=200, right_speed=0, angle=90, stop=True)
+    (TURN, 200, 0, 90),
 
     # move back to align with the ship
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-550, target_angle=90, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(7)))
+    (DRIVE, -550, 90, 7),
 
     # bring arm down (2) to engage with research vessel
-    await motor.run_for_degrees(port.C, 1100, 1000)
-
-    # go forward with boat to get in the docking area
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-2.5, ki=0, kd=0, speed=800, target_angle=88, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(54)))
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-2.5, ki=0, kd=0, speed=400, target_angle=88, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(22)))
+    (ARM_WAIT, port.C, 1100, 1000),
+
+    # go forward with boat to get in the docking area, with a stiffer
+    # fixed gain than the schedule as the boat pulls the robot off heading;
+    # the last part at 400 so the tow docks gently (blends, no stop)
+    (DRIVE, 800, 88, 54, 2.5),
+    (DRIVE, 400, 88, 22, 2.5),
 
     # come back to ensure arm dosen't get stuck
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-700, target_angle=88, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(9.5)))
+    (DRIVE, -700, 88, 9.5),
 
     # raise arm so it doesn't get in the way
-    await motor.run_for_degrees(port.C, -1000, 1000)
-    motor.run_for_degrees(port.C, -1000, 1450)
+    (ARM_WAIT, port.C, -1000, 1000),
+    (ARM, port.C, -1000, 1450),
 
     # go forward to leave ship and get in alignment with unexpected encounter
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=900, target_angle=88, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(41)))
+    (DRIVE, 900, 88, 41),
 
     # turn to align with unexpected encounter
-    await pivot_gyro_turn_abs(left_speed=250, right_speed=-250, angle=135, stop=True)
+    (TURN, 300, -300, 135),
 
     # go forward (back) to push unexpected encounter lever and catch creature
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-1000, target_angle=135, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(18)))
-
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-300, target_angle=135, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(18)))
+    (DRIVE, -1000, 135, 18),
+    (DRIVE, -300, 135, 18),
 
     # go back (forward) to base
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=1000, target_angle=135, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(40)))
+    (DRIVE, 1000, 135, 40),
+))
+
+
+async def run3():
+    await run_steps(RUN3, 3)
 
 # END RUN 3
 #----------------------------------------
@@ -560,70 +2158,56 @@ async def run3():
 # RUN 4
 #----------------------------------------
 # run 4 program
-async def run4():
-
-    # go forward to to get out of base and go towards feed the whale fast
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=800, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(35)))
-
-    # go forward to to get out of base and go towards feed the whale slow
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=400, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(7)))
+RUN4 = compile_steps((
+    # go forward to to get out of base and go towards feed the whale
+    (DRIVE, 800, 0, 42),
 
     # turn to avoid shipping lanes
-    await pivot_gyro_turn_abs(left_speed=-200, right_speed=200, angle=-26, stop=True)
+    (TURN, -300, 300, -26),
 
     # go forward to avoid changing shipping lanes
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=400, target_angle=-26, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(23)))
+    (DRIVE, 400, -26, 23),
 
     # turn right to go straight
-    await pivot_gyro_turn_abs(left_speed=150, right_speed=-150, angle=0, stop=True)
+    (TURN, 300, -300, 0),
 
     # go forward slower to align with sonar discovery
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=600, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(27)))
+    (DRIVE, 600, 0, 27),
 
     # turn Sonar Discovery attachment motor to complete Sonar Discovery
-    await motor.run_for_degrees(port.B, -350, -300)
+    (ARM_WAIT, port.B, -350, -300),
 
     # turn Sonar Discovery attachment motor not get stuck in Sonar Discovery
-    await motor.run_for_degrees(port.B, 100, -300)
+    (ARM_WAIT, port.B, 100, -300),
 
     # go backward slower to start aligning with feed the whale
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-600, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degrees_for_distance(13)))
+    (DRIVE, -600, 0, 13),
 
     # turn right to align with feed the whale
-    await pivot_gyro_turn_abs(100, -100, 35, True)
+    (TURN, 300, -300, 35),
 
     # move forward to open whale's mouth
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(21), 0, velocity=600)
+    (MOVE, 600, 21),
 
     # turn motor to move food tray down
-    await motor.run_for_degrees(port.C, 1450, 1100)
+    (ARM_WAIT, port.C, 1450, 1100),
 
     # move motor to lift food tray so it does not make whale vomit while coming back
-    await motor.run_for_degrees(port.C, 250, -1100)
+    (ARM_WAIT, port.C, 250, -1100),
 
     # move robot backward to move away from feed the whale
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(20), 0, velocity=-900)
+    (MOVE, -900, 20),
 
     # turn left to align with base
-    await pivot_gyro_turn_abs(left_speed=-300, right_speed=300, angle=-7, stop=True)
+    (TURN, -300, 300, -7),
 
     # move robot backward to get to base
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(80), 0, velocity=-1100)
+    (MOVE, -1100, 80),
+))
+
+
+async def run4():
+    await run_steps(RUN4, 4)
 
 # END RUN 4
 #----------------------------------------
@@ -632,69 +2216,52 @@ async def run4():
 # RUN 5
 #----------------------------------------
 # run 5 program
-async def run5():
-
-    # move forward to get out of base
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=1000, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-        initial_position=initial_position, distance_to_cover=degrees_for_distance(36))
-
-    # move forward at a lower speed for precision
-    motor.reset_relative_position(port.A, 0)
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=200, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-        initial_position=initial_position, distance_to_cover=degrees_for_distance(5.5))
+RUN5 = compile_steps((
+    # move forward to get out of base, the profile slows down for precision at the end
+    (DRIVE, 1000, 0, 41.5),
 
     # turn left a bit to get the momentum for flicking artifical habitat
-    await pivot_gyro_turn_abs(-400, 400, -15, True)
+    (TURN, -400, 400, -15, False),
 
     # turn right to flick artificial habitat
-    await pivot_gyro_turn_abs(800, -800, 50, True)
+    (TURN, 800, -800, 50, False),
 
     # turn left to get back in alignment with Artifical Habitat
-    await pivot_gyro_turn_abs(-200, 200, 0, True)
+    (TURN, -300, 300, 0),
 
     # move forward to get closer to the mission so mission is set up correctly
-    await motor_pair.move_for_degrees(motor_pair.PAIR_1, degrees_for_distance(18), 0, velocity=400)
+    (MOVE, 400, 18),
 
     # move robot back to complete alignment with Artificial Habitat
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-600, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-        initial_position=initial_position, distance_to_cover=degrees_for_distance(20))
+    # and bring scooper down once clear of it to get ready to slightly lift mission up
+    (ARM_AFTER, port.B, 100, 150, 10),
+    (DRIVE, -600, 0, 20),
 
-    # bring scooper down to get ready to slightly lift mission up
-    await motor.run_for_degrees(port.B, 100, 150)
+    # wait for the scooper to be all the way down before driving it in
+    (ARM_DONE, port.B),
 
     # move robot forward to get scooper under artificial habitat
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=300, target_angle=-3, sleep_time=0, follow_for=follow_for_distance,
-        initial_position=initial_position, distance_to_cover=degrees_for_distance(9))
+    (DRIVE, 300, -3, 9),
 
     # bring scooper up to complete mission
-    await motor.run_for_degrees(port.B, -195, 1050, acceleration=5000)
+    (ARM_WAIT, port.B, -195, 1050, 5000),
 
     # move robot forward to push crab facing up and to align with mission
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=500, target_angle=-8, sleep_time=0, follow_for=follow_for_distance,
-        initial_position=initial_position, distance_to_cover=degrees_for_distance(20))
+    (DRIVE, 500, -8, 20),
 
     # move robot back to move away from Artificial Habitat
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=1.45, ki=0, kd=0, speed=-800, target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-        initial_position=initial_position, distance_to_cover=degrees_for_distance(8))
+    (DRIVE, -800, 0, 8),
 
     # turn right to go towards Unexpected encounter dropoff
-    await pivot_gyro_turn_abs(300, -300, 57, True)
+    (TURN, 300, -300, 57),
 
     # move robot forward to keep going towards Unexpected encounter dropoff
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45, ki=0, kd=0, speed=1100, target_angle=57, sleep_time=0, follow_for=follow_for_distance,
-        initial_position=initial_position, distance_to_cover=degrees_for_distance(35))
+    (DRIVE, 1100, 57, 35),
+))
+
+
+async def run5():
+    await run_steps(RUN5, 5)
 
 # END RUN 5
 #----------------------------------------
@@ -719,6 +2286,9 @@ async def execute(run_numbers=None):
 
     start_times = [time.ticks_ms() for _ in runs_to_execute]
     end_times = [time.ticks_ms() for _ in runs_to_execute]
+    # battery voltage (mV) at the start and end of every run
+    start_voltages = [0 for _ in runs_to_execute]
+    end_voltages = [0 for _ in runs_to_execute]
 
     run_functions_map = {
                             1: run1, # or run1a
@@ -733,7 +2303,7 @@ async def execute(run_numbers=None):
     # Define motor pai for robot movements
     motor_pair.pair(motor_pair.PAIR_1, port.A, port.E)
 
-    do_init()
+    await do_init(calibrate=True)
     light_matrix.write("0")
     light.color(light.POWER, color.RED)
 
@@ -747,15 +2317,22 @@ async def execute(run_numbers=None):
         light_matrix.show_image(light_matrix.IMAGE_BUTTERFLY)
 
         start_times[i] = time.ticks_ms()
-        do_init()
+        await do_init()
+        sample_log.reset()
+        start_voltages[i] = battery.voltage
 
         runloop.run(run_functions_map[run_number]())
         end_times[i] = time.ticks_ms()
+        end_voltages[i] = battery.sample(force=True)
         light.color(light.POWER, color.YELLOW)
+        # print the run's samples between runs, not counted in its time
+        if LOG_SAMPLES and LOG_EACH_RUN:
+            sample_log.flush(run_number)
 
         if i > 0:
             print("Transition time: " + str(get_time_taken_in_seconds(end_times[i - 1], start_times[i])) + " s")
-        print("Run " + str(run_number) + " time " + str(get_time_taken_in_seconds(start_times[i], end_times[i])) + " s")
+        print("Run " + str(run_number) + " time " + str(get_time_taken_in_seconds(start_times[i], end_times[i])) + " s"
+              + battery_summary(start_voltages[i], end_voltages[i]))
         print("---------------------------------------------------------------------------")
 
     # Print execution times
@@ -773,7 +2350,7 @@ async def execute(run_numbers=None):
             total_time += transition_time
 
         run_time = get_time_taken_in_seconds(start_times[i], end_times[i])
-        print("Run " + str(run_number) + " time " + str(run_time) + " s")
+        print("Run " + str(run_number) + " time " + str(run_time) + " s" + battery_summary(start_voltages[i], end_voltages[i]))
         total_runs_time += run_time
         total_time += run_time
 
@@ -785,6 +2362,17 @@ async def execute(run_numbers=None):
 
     print("***************************************************************************")
 
+    if LOG_SAMPLES and not LOG_EACH_RUN and runs_to_execute:
+        sample_log.flush(runs_to_execute[-1])
+
+    if PROFILE_STEPS:
+        run_steps_map = {1: RUN1, 2: RUN2, 3: RUN3, 4: RUN4, 5: RUN5}
+        for run_number in runs_to_execute:
+            print_step_report(run_number, run_steps_map[run_number])
+        if PRINT_STEP_CSV:
+            print_step_csv(run_steps_map)
+        print("***************************************************************************")
+
 
 # END MAIN EXECUTE FUNCTION
 #----------------------------------------
@@ -805,3 +2393,12 @@ runloop.run(execute([1, 2, 3, 4, 5]))
 
 # SLOT 4 - Run 5
 # runloop.run(execute([5]))
+
+# SLOT 5 - Line sensor calibration
+# runloop.run(calibrate_line_sensors())
+
+# SLOT 6 - Distance calibration (after line sensor calibration)
+# runloop.run(calibrate_distances())
+
+# SLOT 7 - Track width calibration
+# runloop.run(calibrate_track_width())
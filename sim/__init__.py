@@ -0,0 +1,18 @@
+# Host-side SPIKE Prime simulator
+#
+# Runs the hub programs (princess.py, tests.py) on a dev box against
+# pure-Python stand-ins for hub, motor, motor_pair, runloop, color,
+# color_sensor and time. The robot is a kinematic differential drive
+# on a virtual clock, so runs finish faster than real time.
+#
+#   python -m sim                      # princess.py, SLOT 0
+#   python -m sim princess.py --runs 3 # a single run
+#   python -m sim tests.py
+#   python -m sim | python -m sim.log -  # decode the sample log
+#   python -m sim.tune drive             # tune the drive gain schedule
+#   python -m sim.montecarlo --runs 3    # robustness sweep (needs NumPy)
+#   python -m sim.bench                  # compare run times with the baseline
+#   python -m sim.scenarios              # check primitives the runs do not use
+
+from sim.loader import load_program, run
+from sim.world import SimulationTimeout, World
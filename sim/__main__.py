@@ -0,0 +1,38 @@
+# Command line entry point: python -m sim [program] [--runs N ...]
+
+import argparse
+import os
+import time
+
+from sim import World, load_program, run
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim", description="Run a hub program in the simulator.")
+    parser.add_argument("program", nargs="?", default=os.path.join(ROOT, "princess.py"))
+    parser.add_argument("--runs", type=int, nargs="+",
+                        help="run numbers to pass to execute() instead of the program's own slot")
+    parser.add_argument("--transition-ms", type=int, default=0,
+                        help="simulated time between runs before LEFT is pressed")
+    parser.add_argument("--time-limit", type=float, default=900,
+                        help="abort after this many simulated seconds")
+    args = parser.parse_args(argv)
+
+    world = World(time_limit_s=args.time_limit, transition_ms=args.transition_ms)
+    wall_start = time.perf_counter()
+    if args.runs:
+        program = load_program(args.program, world, autorun=False)
+        run(program.execute(args.runs), world)
+    else:
+        load_program(args.program, world)
+    wall = time.perf_counter() - wall_start
+
+    simulated = world.now_us / 1000000.0
+    print("SIMULATED MISSION TIME = {:.3f} s (wall {:.2f} s, {:.0f}x real time, {} hardware calls)".format(
+        simulated, wall, simulated / wall if wall else 0, world.calls))
+
+
+if __name__ == "__main__":
+    main()
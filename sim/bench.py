@@ -0,0 +1,159 @@
+# Simulated benchmark of the mission runs against a stored baseline
+#
+# Runs run1..run5 from princess.py one at a time and the whole
+# execute([1, 2, 3, 4, 5]) sequence on a fresh world each, and records
+# the simulated duration, every step's duration, runloop sleeps (one per
+# control loop iteration) and sensor reads. Compared with the baseline
+# JSON; anything slower or busier than its thresholds fails with exit
+# status 1, so a change that adds seconds to a run shows up here.
+#
+#   python -m sim.bench             # compare with sim/bench_baseline.json
+#   python -m sim.bench --update    # accept the current numbers
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+
+from sim import World, load_program, run
+from sim import world as _world
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, "sim", "bench_baseline.json")
+
+# allowed growth before a benchmark fails, written into new baselines
+THRESHOLDS = {
+    # run and sequence duration, percent
+    "duration_pct": 1.0,
+    # single step duration, milliseconds
+    "step_ms": 100,
+    # loop iterations and sensor reads, percent
+    "count_pct": 5.0,
+}
+
+RUNS = (1, 2, 3, 4, 5)
+
+
+def _measure(program, coroutine, world):
+    # run coroutine with the program's output swallowed
+    with contextlib.redirect_stdout(io.StringIO()):
+        run(coroutine, world)
+    return {
+        "duration_s": round(world.now_us / 1000000.0, 3),
+        "loop_iterations": world.sleeps,
+        "sensor_reads": world.reads,
+    }
+
+
+def _new_world(program):
+    world = _world.use(World())
+    program.motor_pair.pair(program.motor_pair.PAIR_1, program.port.A, program.port.E)
+    with contextlib.redirect_stdout(io.StringIO()):
+        run(program.do_init(calibrate=True), world)
+    # count from the start of the run
+    world.now_us = 0
+    world.reads = world.sleeps = world.calls = 0
+    return world
+
+
+def benchmark(path):
+    # {"runs": {"1": {...}, ...}, "execute": {...}} for the program at path
+    program = load_program(path, World(), autorun=False)
+    program.LOG_SAMPLES = False
+    program.PRINT_LOOP_STATS = False
+    results = {"runs": {}}
+    for run_number in RUNS:
+        world = _new_world(program)
+        program.step_times = []
+        program.arm_times = []
+        result = _measure(program, getattr(program, "run" + str(run_number))(), world)
+        steps = getattr(program, "RUN" + str(run_number))
+        result["steps"] = [[program.describe_step(steps[index]), round(duration_us / 1000.0, 1)]
+                           for _, index, _, duration_us in program.step_times]
+        results["runs"][str(run_number)] = result
+
+    world = _world.use(World())
+    program.step_times = []
+    program.arm_times = []
+    results["execute"] = _measure(program, program.execute(list(RUNS)), world)
+    return results
+
+
+def _grew(new, old, percent):
+    return new > old * (1 + percent / 100.0)
+
+
+def compare(results, baseline):
+    # (failures, notes) as lines of text
+    thresholds = baseline.get("thresholds", THRESHOLDS)
+    failures = []
+    notes = []
+
+    def check(label, new, old):
+        if _grew(new["duration_s"], old["duration_s"], thresholds["duration_pct"]):
+            failures.append("{}: {:.3f} s, baseline {:.3f} s".format(label, new["duration_s"], old["duration_s"]))
+        elif new["duration_s"] < old["duration_s"]:
+            notes.append("{}: {:.3f} s faster".format(label, old["duration_s"] - new["duration_s"]))
+        for key in ("loop_iterations", "sensor_reads"):
+            if _grew(new[key], old[key], thresholds["count_pct"]):
+                failures.append("{}: {} {}, baseline {}".format(label, new[key], key, old[key]))
+
+    for run_number, old in sorted(baseline["runs"].items()):
+        new = results["runs"].get(run_number)
+        if new is None:
+            notes.append("run {}: not benchmarked".format(run_number))
+            continue
+        check("run " + run_number, new, old)
+        if [s[0] for s in new["steps"]] != [s[0] for s in old["steps"]]:
+            notes.append("run {}: steps changed, step times not compared".format(run_number))
+            continue
+        for index, ((step, new_ms), (_, old_ms)) in enumerate(zip(new["steps"], old["steps"])):
+            if new_ms > old_ms + thresholds["step_ms"]:
+                failures.append("run {} #{} {}: {:.0f} ms, baseline {:.0f} ms".format(
+                    run_number, index, step, new_ms, old_ms))
+    check("execute", results["execute"], baseline["execute"])
+    return failures, notes
+
+
+def print_results(results):
+    print("run       duration_s  loop_iterations  sensor_reads")
+    for run_number, result in sorted(results["runs"].items()):
+        print("{:8}  {:10.3f}  {:15}  {:12}".format(run_number, result["duration_s"], result["loop_iterations"],
+                                                    result["sensor_reads"]))
+    result = results["execute"]
+    print("{:8}  {:10.3f}  {:15}  {:12}".format("execute", result["duration_s"], result["loop_iterations"],
+                                                result["sensor_reads"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim.bench", description="Benchmark the runs in the simulator.")
+    parser.add_argument("--program", default=os.path.join(ROOT, "princess.py"))
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update", action="store_true", help="write the results as the new baseline")
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.program)
+    print_results(results)
+
+    if args.update or not os.path.exists(args.baseline):
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(dict(results, thresholds=THRESHOLDS), baseline_file, indent=1)
+            baseline_file.write("\n")
+        print("baseline written to " + args.baseline)
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    failures, notes = compare(results, baseline)
+    for note in notes:
+        print("  " + note)
+    for failure in failures:
+        print("SLOWER " + failure)
+    print("{} regressions".format(len(failures)))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
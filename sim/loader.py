@@ -0,0 +1,73 @@
+# Load a hub program against the stand-in SPIKE modules
+
+import ast
+import os
+import sys
+import types
+
+from sim import world as _world
+from sim.spike import color, color_sensor, device, hub, motor, motor_pair, orientation, runloop, utime
+
+
+STAND_INS = {
+    "color": color,
+    "color_sensor": color_sensor,
+    "device": device,
+    "hub": hub,
+    "hub.button": hub.button,
+    "hub.light": hub.light,
+    "hub.light_matrix": hub.light_matrix,
+    "hub.motion_sensor": hub.motion_sensor,
+    "hub.port": hub.port,
+    "hub.sound": hub.sound,
+    "motor": motor,
+    "motor_pair": motor_pair,
+    "orientation": orientation,
+    "runloop": runloop,
+    "time": utime,
+}
+
+
+def _is_runloop_run(node):
+    # top level `runloop.run(...)` statement that starts the program
+    if not isinstance(node, ast.Expr) or not isinstance(node.value, ast.Call):
+        return False
+    func = node.value.func
+    return (isinstance(func, ast.Attribute) and func.attr == "run"
+            and isinstance(func.value, ast.Name) and func.value.id == "runloop")
+
+
+def load_program(path, world=None, autorun=True):
+    # Execute a hub program and return it as a module. With autorun=False
+    # the top level runloop.run(...) calls are dropped so single runs or
+    # functions can be driven by the caller.
+    world = _world.use(world or _world.World())
+    with open(path) as source_file:
+        tree = ast.parse(source_file.read(), filename=path)
+    if not autorun:
+        tree.body = [node for node in tree.body if not _is_runloop_run(node)]
+    code = compile(tree, path, "exec")
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    module = types.ModuleType(name)
+    module.__file__ = path
+    module.world = world
+
+    saved = {key: sys.modules.get(key) for key in STAND_INS}
+    sys.modules.update(STAND_INS)
+    try:
+        exec(code, module.__dict__)
+    finally:
+        for key, previous in saved.items():
+            if previous is None:
+                del sys.modules[key]
+            else:
+                sys.modules[key] = previous
+    return module
+
+
+def run(coroutine, world=None):
+    # drive a coroutine to completion on the simulated runloop
+    if world is not None:
+        _world.use(world)
+    return runloop.run(coroutine)
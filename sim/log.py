@@ -0,0 +1,108 @@
+# Decode the sample log printed by princess.py at the end of execute
+#
+# After every run the hub prints LOG <format> <fields> <count> run <n>,
+# one line per sample (fixed-width hex or csv) and END LOG. Each sample
+# is (time_ms, segment, yaw_decideg, travel, steering, velocity), travel
+# being the hub's pose.travel in forward wheel degrees; time and segment
+# ids start over every run. Samples are grouped by segment and the
+# trajectory is rebuilt from travel and yaw.
+#
+#   python -m sim | python -m sim.log -          # per segment summary, first run
+#   python -m sim.log console.txt --run 3 --csv  # full trajectory of run 3
+
+import argparse
+import math
+import sys
+
+# keep in sync with WHEEL_CIRCUMFERENCE in princess.py
+WHEEL_CIRCUMFERENCE = 17.584
+
+FIELDS = ("time_ms", "segment", "yaw", "travel", "steering", "velocity")
+
+
+def _signed(value):
+    return value - (1 << 32) if value & 0x80000000 else value
+
+
+def parse(lines, run=None):
+    # samples from the LOG block of run (the first block if None) in lines,
+    # as tuples with yaw in degrees
+    samples = []
+    format = None
+    fields = len(FIELDS)
+    for line in lines:
+        line = line.strip()
+        if format is None:
+            if line.startswith("LOG "):
+                parts = line.split()
+                if run is None or (len(parts) > 5 and parts[4] == "run" and int(parts[5]) == run):
+                    format, fields = parts[1], int(parts[2])
+            continue
+        if line == "END LOG":
+            break
+        if format == "csv":
+            values = [int(v) for v in line.split(",")]
+        else:
+            values = [_signed(int(line[i:i + 8], 16)) for i in range(0, fields * 8, 8)]
+        values[2] = values[2] / 10.0
+        samples.append(tuple(values))
+    if format is None:
+        raise ValueError("no LOG block found" if run is None else "no LOG block for run {}".format(run))
+    return samples
+
+
+def trajectory(samples):
+    # (time_ms, segment, x_cm, y_cm, yaw, steering, velocity) per sample;
+    # heading is clockwise positive like the hub yaw
+    points = []
+    x = y = 0.0
+    last_travel = None
+    for time_ms, segment, yaw, travel, steering, velocity in samples:
+        if last_travel is not None:
+            distance = (travel - last_travel) * WHEEL_CIRCUMFERENCE / 360.0
+            x += distance * math.cos(math.radians(yaw))
+            y += distance * math.sin(math.radians(yaw))
+        last_travel = travel
+        points.append((time_ms, segment, x, y, yaw, steering, velocity))
+    return points
+
+
+def segments(points):
+    # points grouped by segment id, in order
+    grouped = {}
+    for point in points:
+        grouped.setdefault(point[1], []).append(point)
+    return grouped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim.log", description="Decode a hub sample log.")
+    parser.add_argument("file", help="console output containing the LOG block, - for stdin")
+    parser.add_argument("--run", type=int, help="run number to decode (default: the first run logged)")
+    parser.add_argument("--csv", action="store_true", help="print every sample instead of a per segment summary")
+    args = parser.parse_args(argv)
+
+    if args.file == "-":
+        samples = parse(sys.stdin, args.run)
+    else:
+        with open(args.file) as log_file:
+            samples = parse(log_file, args.run)
+    points = trajectory(samples)
+
+    if args.csv:
+        print("segment,time_ms,x_cm,y_cm,yaw,steering,velocity")
+        for time_ms, segment, x, y, yaw, steering, velocity in points:
+            print("{},{},{:.2f},{:.2f},{:.1f},{},{}".format(segment, time_ms, x, y, yaw, steering, velocity))
+        return
+
+    print("segment  samples  duration_ms  distance_cm  yaw_start  yaw_end  max_steering  max_velocity")
+    for segment, group in segments(points).items():
+        first, last = group[0], group[-1]
+        distance = math.hypot(last[2] - first[2], last[3] - first[3])
+        print("{:7}  {:7}  {:11}  {:11.1f}  {:9.1f}  {:7.1f}  {:12}  {:12}".format(
+            segment, len(group), last[0] - first[0], distance, first[4], last[4],
+            max(abs(p[5]) for p in group), max(abs(p[6]) for p in group)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# Monte Carlo robustness sweep of the mission runs
+#
+# Executes run1..run5 from princess.py many times on the simulator, each
+# trial drawing its own gyro noise and drift, gyro delay, wheel slip,
+# motor response lag and placement error in base. Trials run on a
+# process pool; the pose after every step is compared with a trial
+# without disturbances and aggregated with NumPy into per-step error
+# distributions and the probability that each run ends within tolerance.
+# Needs NumPy, unlike the rest of the simulator.
+#
+#   python -m sim.montecarlo --runs 3 --trials 2000
+#   python -m sim.montecarlo --slip 0.02 --placement-cm 1   # rougher mat
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import os
+import random
+
+import numpy as np
+
+from sim import World, SimulationTimeout, load_program, run
+from sim import world as _world
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# program loaded once per worker process
+_program = None
+
+
+def _init_worker(path):
+    global _program
+    _program = load_program(path, World(), autorun=False)
+    _program.LOG_SAMPLES = False
+    _program.PRINT_LOOP_STATS = False
+
+
+class _StepPoses(list):
+    # stands in for the program's step_times: run_steps appends to it
+    # after every step, which is when the robot's true pose is recorded
+
+    def __init__(self, world):
+        super().__init__()
+        self.world = world
+        self.poses = []
+
+    def append(self, item):
+        super().append(item)
+        self.poses.append((self.world.x, self.world.y, self.world.heading))
+
+
+def draw_disturbance(rng, spread):
+    # one trial's imperfections from the spread given on the command line
+    return {
+        "yaw_noise": spread["yaw_noise"],
+        "yaw_drift": rng.gauss(0.0, spread["yaw_drift"]) if spread["yaw_drift"] else 0.0,
+        "yaw_delay_ms": rng.uniform(0.0, spread["yaw_delay_ms"]),
+        "response_ms": rng.uniform(0.0, spread["motor_lag_ms"]),
+        "traction": tuple(1.0 - abs(rng.gauss(0.0, spread["slip"])) if spread["slip"] else 1.0 for _ in range(2)),
+        "placement": (spread["placement_cm"], spread["placement_cm"], spread["placement_deg"]),
+    }
+
+
+def trial(task):
+    # true pose (x, y, heading) after every step of one run, None if the
+    # run did not finish
+    run_number, seed, spread = task
+    rng = random.Random(seed)
+    disturbance = draw_disturbance(rng, spread)
+    world = _world.use(World(time_limit_s=150))
+    world.random = rng
+    world.yaw_noise = disturbance["yaw_noise"]
+    world.yaw_drift = disturbance["yaw_drift"]
+    world.yaw_delay_us = int(disturbance["yaw_delay_ms"] * 1000)
+    world.placement_error = disturbance["placement"]
+    for motor in world.motors.values():
+        motor.response_s = disturbance["response_ms"] / 1000.0
+    world.traction[_program.port.A], world.traction[_program.port.E] = disturbance["traction"]
+    world.place_robot()
+
+    # the program's globals live on across the trials in this worker: a
+    # trial that timed out leaves its arm moves queued and its run open
+    for queue in _program.attachments.queues.values():
+        del queue[:]
+    _program.attachments.closed = True
+    _program.heading_tracker.reset()
+    _program.pose.reset()
+    _program.motor_pair.pair(_program.motor_pair.PAIR_1, _program.port.A, _program.port.E)
+    with contextlib.redirect_stdout(io.StringIO()):
+        run(_program.do_init(calibrate=True), world)
+    _program.step_times = _StepPoses(world)
+    _program.arm_times = []
+    try:
+        run(getattr(_program, "run" + str(run_number))(), world)
+    except SimulationTimeout:
+        return None
+    return _program.step_times.poses
+
+
+def run_trials(run_number, trials, seed, spread, program, jobs=None):
+    # (nominal poses, [poses or None per trial]) for one run
+    quiet = {key: 0 for key in spread}
+    tasks = [(run_number, 0, quiet)] + [(run_number, seed + i, spread) for i in range(trials)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                                initargs=(program,)) as pool:
+        results = list(pool.map(trial, tasks, chunksize=max(1, len(tasks) // (4 * (jobs or os.cpu_count() or 1)))))
+    return results[0], results[1:]
+
+
+def step_errors(nominal, results):
+    # position (cm) and heading (deg) error per finished trial and step,
+    # shape (trials, steps), plus how many trials did not finish
+    finished = [poses for poses in results if poses is not None and len(poses) == len(nominal)]
+    poses = np.array(finished, dtype=float).reshape(len(finished), len(nominal), 3)
+    expected = np.array(nominal, dtype=float)
+    position = np.hypot(poses[:, :, 0] - expected[:, 0], poses[:, :, 1] - expected[:, 1])
+    heading = np.abs((poses[:, :, 2] - expected[:, 2] + 180.0) % 360.0 - 180.0)
+    return position, heading, len(results) - len(finished)
+
+
+def report(run_number, steps, position, heading, unfinished, tolerance_cm, tolerance_deg):
+    trials = position.shape[0] + unfinished
+    print("Run {}: {} trials, {} did not finish".format(run_number, trials, unfinished))
+    print("  step                       position cm mean/p95/max   heading deg mean/p95/max")
+    if position.shape[0]:
+        for index, step in enumerate(steps):
+            p, h = position[:, index], heading[:, index]
+            print("  #{:<3} {:22} {:6.2f} {:6.2f} {:6.2f}     {:6.2f} {:6.2f} {:6.2f}".format(
+                index, _program.describe_step(step)[:22], p.mean(), np.percentile(p, 95), p.max(),
+                h.mean(), np.percentile(h, 95), h.max()))
+        landed = np.count_nonzero((position[:, -1] <= tolerance_cm) & (heading[:, -1] <= tolerance_deg))
+    else:
+        landed = 0
+    print("  end pose within {} cm and {} deg: {:.1%}".format(tolerance_cm, tolerance_deg, landed / trials))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim.montecarlo", description="Monte Carlo sweep of the runs.")
+    parser.add_argument("--program", default=os.path.join(ROOT, "princess.py"))
+    parser.add_argument("--runs", type=int, nargs="+", default=[1, 2, 3, 4, 5])
+    parser.add_argument("--trials", type=int, default=1000, help="trials per run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--jobs", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--tolerance-cm", type=float, default=2.0)
+    parser.add_argument("--tolerance-deg", type=float, default=3.0)
+    parser.add_argument("--yaw-noise", type=float, default=0.1, help="gyro noise per read, degrees (sd)")
+    parser.add_argument("--yaw-drift", type=float, default=0.02, help="gyro drift, deg/s (sd)")
+    parser.add_argument("--yaw-delay-ms", type=float, default=20, help="gyro delay, up to")
+    parser.add_argument("--motor-lag-ms", type=float, default=20, help="motor response time constant, up to")
+    parser.add_argument("--slip", type=float, default=0.01, help="wheel travel lost to slip (sd)")
+    parser.add_argument("--placement-cm", type=float, default=0.5, help="placement error in base (sd)")
+    parser.add_argument("--placement-deg", type=float, default=0.5, help="placement heading error (sd)")
+    args = parser.parse_args(argv)
+
+    spread = {"yaw_noise": args.yaw_noise, "yaw_drift": args.yaw_drift, "yaw_delay_ms": args.yaw_delay_ms,
+              "motor_lag_ms": args.motor_lag_ms, "slip": args.slip, "placement_cm": args.placement_cm,
+              "placement_deg": args.placement_deg}
+    _init_worker(args.program)
+    for run_number in args.runs:
+        nominal, results = run_trials(run_number, args.trials, args.seed, spread, args.program, args.jobs)
+        if nominal is None:
+            print("Run {}: does not finish without disturbances".format(run_number))
+            continue
+        steps = getattr(_program, "RUN" + str(run_number))
+        position, heading, unfinished = step_errors(nominal, results)
+        report(run_number, steps, position, heading, unfinished, args.tolerance_cm, args.tolerance_deg)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+# Simulated checks of the motion primitives the runs don't exercise
+#
+# Each scenario runs one primitive from princess.py on a fresh world
+# and checks where the robot ends up (and how long it took) against a
+# tolerance. Prints one line per check and exits with status 1 if any
+# fails, like sim.bench.
+#
+#   python -m sim.scenarios                    # every scenario
+#   python -m sim.scenarios pivot_blocked      # just the ones named
+
+import argparse
+import contextlib
+import io
+import math
+import os
+import sys
+import tempfile
+
+from sim import World, SimulationTimeout, load_program, run
+from sim import world as _world
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _new_world(program, **settings):
+    # fresh world with the drive pair set up and the program's trackers at 0
+    world = _world.use(World(time_limit_s=60))
+    for name, value in settings.items():
+        setattr(world, name, value)
+    # and nothing left over from a scenario that hung
+    for queue in program.attachments.queues.values():
+        del queue[:]
+    program.attachments.closed = True
+    program.motor_pair.pair(program.motor_pair.PAIR_1, program.port.A, program.port.E)
+    with contextlib.redirect_stdout(io.StringIO()):
+        run(program.do_init(), world)
+    return world
+
+
+def _run(program, coroutine, world):
+    # run coroutine quietly: its result and the seconds it took, inf if it hung
+    start_us = world.now_us
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = run(coroutine, world)
+    except SimulationTimeout:
+        return None, float("inf")
+    return result, (world.now_us - start_us) / 1000000.0
+
+
+def _check(label, value, low, high):
+    return label, value, low <= value <= high, "{} .. {}".format(low, high)
+
+
+def gyro_drift_slow(program):
+    # a drift too slow to move the yaw a 0.1 degree step in the first
+    # fraction of a second is still measured
+    world = _new_world(program, yaw_drift=0.05)
+    drift, seconds = _run(program, program.measure_gyro_drift(), world)
+    return [_check("drift deg/s", drift, 0.04, 0.06), _check("time s", seconds, 0, 5.1)]
+
+
+def gyro_drift_fast(program):
+    world = _new_world(program, yaw_drift=-0.3)
+    drift, seconds = _run(program, program.measure_gyro_drift(), world)
+    return [_check("drift deg/s", drift, -0.33, -0.27), _check("time s", seconds, 0, 2)]
+
+
+def pivot_blocked(program):
+    # a pivot against a wall gives up instead of hanging the run
+    world = _new_world(program)
+    world.motors[program.port.A].jammed = world.motors[program.port.E].jammed = True
+    _, seconds = _run(program, program.pivot_gyro_turn_abs(300, -300, 90, stop=True), world)
+    return [_check("time s", seconds, 0, 1)]
+
+
+def pivot_slow(program):
+    # a one-wheel turn slower than STALL_PROGRESS a window (mat friction
+    # holding a 70 deg/s wheel to 55) is not taken for a stall
+    world = _new_world(program)
+    _run(program, program.pivot_gyro_turn_abs(0, 55, -30, stop=True), world)
+    return [_check("heading", world.heading, -31, -29)]
+
+
+def pivot_slow_blocked(program):
+    world = _new_world(program)
+    world.motors[program.port.E].jammed = True
+    _, seconds = _run(program, program.pivot_gyro_turn_abs(0, 70, -30, stop=True), world)
+    return [_check("time s", seconds, 0, 1)]
+
+
+def pivot_overshoot(program):
+    # a late gyro lets a fast pivot overshoot by more than 30 degrees;
+    # settling must not turn that (it peaks at about 150) into a full circle
+    world = _new_world(program, yaw_delay_us=100000)
+    _, seconds = _run(program, program.pivot_gyro_turn_abs(800, -800, 90, stop=True), world)
+    return [_check("heading", world.heading, 75, 105), _check("time s", seconds, 0, 3)]
+
+
+def pivot_no_speed(program):
+    _, seconds = _run(program, program.pivot_gyro_turn_abs(0, 0, 90, stop=True), _new_world(program))
+    return [_check("time s", seconds, 0, 0.01)]
+
+
+def path_rectangle(program):
+    # a 40 x 30 cm rectangle of waypoints comes back to the start
+    world = _new_world(program)
+    _, seconds = _run(program, program.path(((40, 0), (40, 30), (0, 30), (0, 0))), world)
+    return [_check("miss cm", math.hypot(world.x, world.y), 0, 1.5), _check("time s", seconds, 0, 10)]
+
+
+def drive_to_behind(program):
+    # a waypoint behind the robot is reached backing up, without a turn
+    world = _new_world(program)
+    _run(program, program.drive_to(-30, 0), world)
+    return [_check("x cm", world.x, -31, -29), _check("heading", world.heading, -1, 1)]
+
+
+def arm_after_blocked(program):
+    # an ARM_AFTER rides on a drive that is blocked before its distance;
+    # the move still happens and the run ends
+    world = _new_world(program)
+    world.motors[program.port.A].jammed = world.motors[program.port.E].jammed = True
+    steps = program.compile_steps(((program.ARM_AFTER, program.port.B, 100, 300, 10),
+                                   (program.DRIVE, 400, 0, 30)))
+    _, seconds = _run(program, program.run_steps(steps), world)
+    return [_check("time s", seconds, 0, 2), _check("arm deg", world.motors[program.port.B].position, 98, 102)]
+
+
+def path_nested(program):
+    # a path driven from inside a run shares its attachment workers: an
+    # arm move queued before it runs once, and later moves still run
+    world = _new_world(program)
+    arm = program.port.B
+
+    async def steps():
+        program.attachments.queue(arm, 200, 300)
+        await program.drive_to(20, 0)
+        await program.attachments.queue(arm, 100, 300).wait()
+
+    _, seconds = _run(program, program.attachments.run(steps()), world)
+    return [_check("time s", seconds, 0, 5), _check("arm deg", world.motors[arm].position, 298, 302),
+            _check("x cm", world.x, 19, 21)]
+
+
+def arc_quarter(program):
+    # a quarter arc of radius 20 cm to the right lands on the circle
+    world = _new_world(program)
+    _run(program, program.arc_gyro_turn(400, 20, angle=90), world)
+    return [_check("x cm", world.x, 19, 21), _check("y cm", world.y, 19, 21),
+            _check("heading", world.heading, 88, 92)]
+
+
+def arc_backward_left(program):
+    # backing up with the path curving to the robot's left (-y) turns it
+    # clockwise, so a quarter arc ends at (-20, -20) facing 90
+    world = _new_world(program)
+    _run(program, program.arc_gyro_turn(-400, -20, angle=90), world)
+    return [_check("x cm", world.x, -21, -19), _check("y cm", world.y, -21, -19),
+            _check("heading", world.heading, 88, 92)]
+
+
+def arc_no_radius(program):
+    world = _new_world(program)
+    _, seconds = _run(program, program.arc_gyro_turn(400, 0, angle=90), world)
+    return [_check("time s", seconds, 0, 0.01), _check("heading", world.heading, -0.5, 0.5)]
+
+
+def _track_width(program, track):
+    # calibrate_track_width on a robot whose wheels are track cm apart
+    saved = _world.TRACK_WIDTH
+    _world.TRACK_WIDTH = track
+    try:
+        world = _new_world(program)
+        measured, seconds = _run(program, program.calibrate_track_width(), world)
+    finally:
+        _world.TRACK_WIDTH = saved
+    return [_check("track cm", measured or 0, round(track - 0.1, 2), round(track + 0.1, 2)), _check("time s", seconds, 0, 20)]
+
+
+def track_width(program):
+    return _track_width(program, 11.2)
+
+
+def track_width_wide(program):
+    # not the value TRACK_WIDTH already holds, so it is really measured
+    return _track_width(program, 12.5)
+
+
+def battery_cap(program):
+    # a battery in normal match use doesn't cap 1100; a drained one does
+    caps = []
+    for battery_mv in (8100, 7000):
+        _new_world(program, battery_mv=battery_mv)
+        program.battery.sample(force=True)
+        caps.append(program.battery.max_speed)
+    return [_check("cap at 8.1 V", caps[0], 1100, 1100), _check("cap at 7.0 V", caps[1], 1000, 1099)]
+
+
+def blend_plan(program):
+    # drives across +-180 blend like any other small heading change; a
+    # drive into a quick (not precise) pivot stops first
+    across = program.compile_steps(((program.DRIVE, 400, 179, 10), (program.DRIVE, 400, -179, 10)))
+    quick = program.compile_steps(((program.DRIVE, 400, 0, 10), (program.TURN, 300, -300, 90, False)))
+    precise = program.compile_steps(((program.DRIVE, 400, 0, 10), (program.TURN, 300, -300, 90)))
+    return [_check("across 180", across[0][6], 400, 400), _check("quick turn", quick[0][6], 0, 0),
+            _check("precise turn", precise[0][6], 1, 400)]
+
+
+def _line_world(program, lines):
+    # line sensors 8 cm ahead of the wheels, 3 cm either side, calibrated
+    # to the simulated mat
+    left, right = program.LINE_SENSOR_LEFT, program.LINE_SENSOR_RIGHT
+    world = _new_world(program, lines=lines, sensor_offsets={left: (8, -3), right: (8, 3)})
+    program.line_calibration[left] = program.line_calibration[right] = (12, 95)
+    return world
+
+
+def _line_distance(x, y, start, end):
+    # distance from (x, y) to the line through start and end
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    return abs(dx * (y - start[1]) - dy * (x - start[0])) / math.hypot(dx, dy)
+
+
+def line_straight(program):
+    # the left sensor starts half a cm off the edge of a 1.5 cm line and
+    # holds it: the robot's center ends 3.75 cm from the line's middle
+    world = _line_world(program, [((-10, -4), (120, -4))])
+    until = program.Distance(program.degrees_for_distance(60))
+    _, seconds = _run(program, program.follow_line(300, program.LINE_SENSOR_LEFT, until), world)
+    return [_check("off line cm", _line_distance(world.x, world.y, (0, -4), (1, -4)), 3.25, 4.25),
+            _check("heading", world.heading, -2, 2), _check("time s", seconds, 0, 6)]
+
+
+def line_bend(program):
+    # the line bends 30 degrees to the right after 30 cm and the follower
+    # comes round with it
+    bend = (30 + 60 * math.cos(math.radians(30)), -4 + 60 * math.sin(math.radians(30)))
+    world = _line_world(program, [((-10, -4), (30, -4)), ((30, -4), bend)])
+    until = program.Distance(program.degrees_for_distance(70))
+    _run(program, program.follow_line(300, program.LINE_SENSOR_LEFT, until), world)
+    return [_check("off line cm", _line_distance(world.x, world.y, (30, -4), bend), 3.25, 4.25),
+            _check("heading", world.heading, 28, 32)]
+
+
+def _square(program, heading):
+    # a line across the path 20 cm ahead, approached heading degrees off square
+    world = _line_world(program, [((20, -30), (20, 30))])
+    world.heading = heading
+    squared, seconds = _run(program, program.square_to_line(heading=0), world)
+    return [_check("squared", 1 if squared else 0, 1, 1), _check("heading", world.heading, -1.5, 1.5),
+            _check("time s", seconds, 0, 3)]
+
+
+def square_from_left(program):
+    return _square(program, -12)
+
+
+def square_from_right(program):
+    return _square(program, 12)
+
+
+def _run_calibration(program, traction=1.0, slip_per_speed=0.0):
+    # calibrate_distances between two lines 41.5 cm apart, edge to same
+    # edge, with both wheels slipping to traction (less the faster they
+    # turn); whether it finished and its table {(direction, speed): scale}
+    world = _line_world(program, [((2, -30), (2, 30)), ((43.5, -30), (43.5, 30))])
+    world.time_limit_us = 300 * 1000000
+    world.traction[program.port.A] = world.traction[program.port.E] = traction
+    world.slip_per_speed = slip_per_speed
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        # the table is written to a file on the hub
+        os.chdir(scratch)
+        try:
+            calibrated, _ = _run(program, program.calibrate_distances(), world)
+        finally:
+            os.chdir(cwd)
+    table = {}
+    for direction in (1, -1):
+        for speed, scale in program.distance_calibration[direction]:
+            table[(direction, speed)] = scale
+    program.distance_calibration = {1: program.DISTANCE_SCALE_FORWARD, -1: program.DISTANCE_SCALE_REVERSE}
+    return calibrated, table
+
+
+def _calibrate(program, traction):
+    # the real cm per commanded cm it finds, lowest and highest over its table
+    calibrated, table = _run_calibration(program, traction)
+    scales = table.values() or [0]
+    return [_check("calibrated", 1 if calibrated else 0, 1, 1),
+            _check("min scale", min(scales), traction - 0.005, traction + 0.005),
+            _check("max scale", max(scales), traction - 0.005, traction + 0.005)]
+
+
+def calibrate_no_slip(program):
+    return _calibrate(program, 1.0)
+
+
+def calibrate_slip(program):
+    return _calibrate(program, 0.97)
+
+
+def calibrate_speed_slip(program):
+    # wheels that slip more the faster they turn (3% per 1000 deg/s): the
+    # slow creep onto the line slips less than the drive before it, and
+    # every row must still match a plain drive of the same length
+    calibrated, table = _run_calibration(program, slip_per_speed=0.03)
+    commanded = program.DISTANCE_CALIBRATION_PITCH - program.DISTANCE_CALIBRATION_SHORT
+    degrees = program.degrees_for_distance(commanded)
+    worst = 0.0
+    for (direction, speed), scale in table.items():
+        world = _new_world(program, slip_per_speed=0.03)
+
+        async def drive():
+            await program.follow_gyro_angle(speed=direction * speed, target_angle=0,
+                                            until=program.Travel(direction * degrees, direction),
+                                            profile_distance=degrees)
+            await program.runloop.sleep_ms(500)
+
+        _run(program, drive(), world)
+        worst = max(worst, abs(scale - abs(world.x) / commanded))
+    return [_check("calibrated", 1 if calibrated and table else 0, 1, 1), _check("worst error", worst, 0, 0.0025)]
+
+
+def zero_scale(program):
+    # a table row of scale 0 is ignored instead of dividing by it
+    expected = program.degrees_for_distance(20)
+    program.distance_calibration = {1: ((0, 0.0),), -1: ((0, 0.0),)}
+    degrees = program.degrees_for_distance(20, 400)
+    program.distance_calibration = {1: program.DISTANCE_SCALE_FORWARD, -1: program.DISTANCE_SCALE_REVERSE}
+    return [_check("degrees", degrees, expected, expected)]
+
+
+SCENARIOS = (
+    gyro_drift_slow,
+    gyro_drift_fast,
+    pivot_blocked,
+    pivot_slow,
+    pivot_slow_blocked,
+    pivot_overshoot,
+    pivot_no_speed,
+    path_rectangle,
+    drive_to_behind,
+    arm_after_blocked,
+    path_nested,
+    arc_quarter,
+    arc_backward_left,
+    arc_no_radius,
+    track_width,
+    track_width_wide,
+    blend_plan,
+    battery_cap,
+    line_straight,
+    line_bend,
+    square_from_left,
+    square_from_right,
+    calibrate_no_slip,
+    calibrate_slip,
+    calibrate_speed_slip,
+    zero_scale,
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim.scenarios", description="Check primitives in the simulator.")
+    parser.add_argument("names", nargs="*", help="scenarios to run (default: all)")
+    parser.add_argument("--program", default=os.path.join(ROOT, "princess.py"))
+    args = parser.parse_args(argv)
+
+    program = load_program(args.program, World(), autorun=False)
+    program.LOG_SAMPLES = False
+    program.PRINT_LOOP_STATS = False
+    failures = 0
+    for scenario in SCENARIOS:
+        if args.names and scenario.__name__ not in args.names:
+            continue
+        for label, value, ok, expected in scenario(program):
+            print("{:4}  {:24} {:10} {:10.3f}  expected {}".format(
+                "ok" if ok else "FAIL", scenario.__name__, label, value, expected))
+            failures += not ok
+    print("{} failed".format(failures))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+# Pure-Python stand-ins for the SPIKE Prime hub modules
@@ -0,0 +1,15 @@
+# Stand-in for the SPIKE color_sensor module
+
+from sim import world as _world
+from sim.spike import color as _color
+
+
+def reflection(port):
+    world = _world.get()
+    world.read()
+    return world.reflection(port)
+
+
+def color(port):
+    _world.get().read()
+    return _color.UNKNOWN
@@ -0,0 +1,5 @@
+# Stand-in for the SPIKE device module
+
+
+def ready(port):
+    return True
@@ -0,0 +1,11 @@
+# Stand-in for the SPIKE hub module
+
+from sim import world as _world
+from sim.spike.hub import button, light, light_matrix, motion_sensor, port, sound
+
+
+def battery_voltage():
+    # mV
+    world = _world.get()
+    world.read()
+    return int(world.battery_mv)
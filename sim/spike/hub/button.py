@@ -0,0 +1,12 @@
+# Stand-in for hub.button
+
+from sim import world as _world
+
+LEFT = 1
+RIGHT = 2
+
+
+def pressed(button):
+    world = _world.get()
+    world.charge()
+    return world.button_pressed(button == LEFT)
@@ -0,0 +1,8 @@
+# Stand-in for hub.light
+
+POWER = 0
+CONNECT = 1
+
+
+def color(light, color):
+    pass
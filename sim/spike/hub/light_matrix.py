@@ -0,0 +1,24 @@
+# Stand-in for hub.light_matrix
+
+
+def __getattr__(name):
+    # IMAGE_* constants
+    if name.startswith("IMAGE_"):
+        return 0
+    raise AttributeError(name)
+
+
+def write(text, intensity=100, time_per_character=500):
+    pass
+
+
+def show_image(image):
+    pass
+
+
+def clear():
+    pass
+
+
+def set_pixel(x, y, intensity):
+    pass
@@ -0,0 +1,31 @@
+# Stand-in for hub.motion_sensor
+
+from sim import world as _world
+
+TOP = 0
+FRONT = 1
+RIGHT = 2
+BOTTOM = 3
+BACK = 4
+LEFT = 5
+
+
+def set_yaw_face(up):
+    return True
+
+
+def reset_yaw(angle):
+    # angle is in decidegrees, counterclockwise positive
+    _world.get().reset_yaw(angle * -0.1)
+
+
+def tilt_angles():
+    # (yaw, pitch, roll) in decidegrees, yaw counterclockwise positive
+    world = _world.get()
+    world.read()
+    return (int(round(world.yaw() * -10)), 0, 0)
+
+
+def stable():
+    _world.get().charge()
+    return True
@@ -0,0 +1,8 @@
+# Stand-in for hub.port
+
+A = 0
+B = 1
+C = 2
+D = 3
+E = 4
+F = 5
@@ -0,0 +1,12 @@
+# Stand-in for hub.sound
+
+
+def beep(freq=440, duration=500, volume=100, **kwargs):
+    class _Done:
+        def __await__(self):
+            return iter(())
+    return _Done()
+
+
+def stop():
+    pass
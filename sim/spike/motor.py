@@ -0,0 +1,96 @@
+# Stand-in for the SPIKE motor module
+
+from sim import world as _world
+
+READY = 0
+RUNNING = 1
+STALLED = 2
+CANCELED = 3
+ERROR = 4
+DISCONNECTED = 5
+
+COAST = _world.COAST
+BRAKE = _world.BRAKE
+HOLD = _world.HOLD
+CONTINUE = 3
+SMART_COAST = 4
+SMART_BRAKE = 5
+
+CLOCKWISE = 0
+COUNTERCLOCKWISE = 1
+SHORTEST_PATH = 2
+LONGEST_PATH = 3
+
+
+class _Completion:
+    # awaitable returned by motor commands; done when the command
+    # finishes or another command takes over the motor
+
+    def __init__(self, motors):
+        self.motors = [(m, m.command) for m in motors]
+
+    def done(self):
+        return all(m.command != c or not m.busy for m, c in self.motors)
+
+    def __await__(self):
+        if not self.done():
+            yield ("until", self.done, None)
+        return READY
+
+
+def _motor(port):
+    world = _world.get()
+    world.charge()
+    return world.motors[port]
+
+
+def _sensor(port):
+    world = _world.get()
+    world.read()
+    return world.motors[port]
+
+
+def run(port, velocity, *, acceleration=1000):
+    _motor(port).run(velocity, acceleration)
+
+
+def run_for_degrees(port, degrees, velocity, *, stop=BRAKE, acceleration=1000, deceleration=1000):
+    motor = _motor(port)
+    motor.run_for_degrees(degrees, velocity, acceleration, deceleration)
+    return _Completion([motor])
+
+
+def run_for_time(port, duration, velocity, *, stop=BRAKE, acceleration=1000, deceleration=1000):
+    motor = _motor(port)
+    motor.run(velocity, acceleration)
+    motor.goal = motor.position + velocity * duration / 1000.0
+    motor.cruise = min(abs(velocity), _world.MAX_SPEED)
+    motor.deceleration = deceleration
+    return _Completion([motor])
+
+
+def run_to_relative_position(port, position, velocity, *, stop=BRAKE, acceleration=1000, deceleration=1000):
+    motor = _motor(port)
+    degrees = position - motor.relative_position()
+    motor.run_for_degrees(degrees, abs(velocity), acceleration, deceleration)
+    return _Completion([motor])
+
+
+def stop(port, *, stop=BRAKE):
+    _motor(port).stop(stop)
+
+
+def relative_position(port):
+    return _sensor(port).relative_position()
+
+
+def reset_relative_position(port, position):
+    _motor(port).reset_relative_position(position)
+
+
+def absolute_position(port):
+    return int(_sensor(port).position + 180) % 360 - 180
+
+
+def velocity(port):
+    return int(_sensor(port).velocity)
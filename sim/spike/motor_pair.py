@@ -0,0 +1,71 @@
+# Stand-in for the SPIKE motor_pair module
+
+from sim import world as _world
+from sim.spike import motor as _motor
+
+PAIR_1 = 0
+PAIR_2 = 1
+PAIR_3 = 2
+
+_pairs = {}
+
+
+def _steer(steering, velocity):
+    # split a steering value (-100..100) into left/right wheel speeds
+    steering = max(-100, min(100, steering))
+    if steering >= 0:
+        return velocity, velocity * (50 - steering) / 50.0
+    return velocity * (50 + steering) / 50.0, velocity
+
+
+def _wheels(pair):
+    world = _world.get()
+    world.charge()
+    left_port, right_port = _pairs[pair]
+    return world, world.motors[left_port], world.motors[right_port]
+
+
+def pair(pair, left_motor, right_motor):
+    _pairs[pair] = (left_motor, right_motor)
+    _world.get().pair(left_motor, right_motor)
+
+
+def unpair(pair):
+    _pairs.pop(pair, None)
+
+
+def move_tank(pair, left_velocity, right_velocity, *, acceleration=1000):
+    world, left, right = _wheels(pair)
+    left_port, right_port = _pairs[pair]
+    left.run(world.mirror[left_port] * left_velocity, acceleration)
+    right.run(world.mirror[right_port] * right_velocity, acceleration)
+
+
+def move(pair, steering, *, velocity=360, acceleration=1000):
+    left_velocity, right_velocity = _steer(steering, velocity)
+    move_tank(pair, left_velocity, right_velocity, acceleration=acceleration)
+
+
+def move_tank_for_degrees(pair, degrees, left_velocity, right_velocity, *, stop=_motor.BRAKE,
+                          acceleration=1000, deceleration=1000):
+    world, left, right = _wheels(pair)
+    left_port, right_port = _pairs[pair]
+    fastest = max(abs(left_velocity), abs(right_velocity)) or 1
+    for port, wheel, velocity in ((left_port, left, left_velocity), (right_port, right, right_velocity)):
+        share = abs(degrees) * abs(velocity) / fastest
+        wheel.run_for_degrees(world.mirror[port] * share, velocity * (1 if degrees >= 0 else -1),
+                              acceleration, deceleration)
+    return _motor._Completion([left, right])
+
+
+def move_for_degrees(pair, degrees, steering, *, velocity=360, stop=_motor.BRAKE,
+                     acceleration=1000, deceleration=1000):
+    left_velocity, right_velocity = _steer(steering, velocity)
+    return move_tank_for_degrees(pair, degrees, left_velocity, right_velocity, stop=stop,
+                                 acceleration=acceleration, deceleration=deceleration)
+
+
+def stop(pair, *, stop=_motor.BRAKE):
+    world, left, right = _wheels(pair)
+    left.stop(stop)
+    right.stop(stop)
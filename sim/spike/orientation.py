@@ -0,0 +1,6 @@
+# Stand-in for the SPIKE orientation module
+
+UP = 0
+RIGHT = 1
+DOWN = 2
+LEFT = 3
@@ -0,0 +1,131 @@
+# Stand-in for the SPIKE runloop module
+#
+# A small cooperative scheduler driven by the virtual clock. Awaitables
+# yield a wait condition back to the loop: ("time", deadline_us) or
+# ("until", predicate, deadline_us or None).
+
+from sim import world as _world
+
+# how often predicates are re-checked while every task is waiting
+POLL_US = 1000
+
+_loops = []
+
+
+class _Task:
+
+    def __init__(self, coroutine):
+        self.coroutine = coroutine
+        self.wait = None
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def ready(self, now):
+        if self.wait is None:
+            return True
+        if self.wait[0] == "time":
+            return now >= self.wait[1]
+        deadline = self.wait[2]
+        return self.wait[1]() or (deadline is not None and now >= deadline)
+
+    def step(self):
+        try:
+            self.wait = self.coroutine.send(None)
+        except StopIteration as stop:
+            self.done = True
+            self.result = stop.value
+        except BaseException as error:
+            self.done = True
+            self.error = error
+
+
+async def _await(awaitable):
+    return await awaitable
+
+
+class _Loop:
+
+    def __init__(self):
+        self.tasks = []
+
+    def spawn(self, coroutine):
+        # motor commands hand back awaitables rather than coroutines
+        if not hasattr(coroutine, "send"):
+            coroutine = _await(coroutine)
+        task = _Task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    def run_until(self, tasks):
+        world = _world.get()
+        while not all(t.done for t in tasks):
+            progressed = False
+            for task in list(self.tasks):
+                if not task.done and task.ready(world.now_us):
+                    task.step()
+                    progressed = True
+                    if task.error is not None and task in tasks:
+                        raise task.error
+            if progressed:
+                continue
+            waiting = [t.wait for t in self.tasks if not t.done]
+            if all(w[0] == "time" for w in waiting):
+                world.advance(max(min(w[1] for w in waiting) - world.now_us, 1))
+            else:
+                world.advance(POLL_US)
+
+
+class _Awaitable:
+
+    def __init__(self, wait):
+        self.wait = wait
+
+    def __await__(self):
+        yield self.wait()
+
+
+class _Gather:
+
+    def __init__(self, coroutines):
+        self.coroutines = coroutines
+
+    def __await__(self):
+        loop = _loops[-1]
+        tasks = [loop.spawn(c) for c in self.coroutines]
+        yield ("until", lambda: all(t.done for t in tasks), None)
+        for task in tasks:
+            if task.error is not None:
+                raise task.error
+        return [t.result for t in tasks]
+
+
+def run(*coroutines):
+    loop = _Loop()
+    _loops.append(loop)
+    try:
+        tasks = [loop.spawn(c) for c in coroutines]
+        loop.run_until(tasks)
+    finally:
+        _loops.pop()
+    if len(tasks) == 1:
+        return tasks[0].result
+
+
+def sleep_ms(duration):
+    def wait():
+        world = _world.get()
+        world.sleeps += 1
+        return ("time", world.now_us + int(duration) * 1000)
+    return _Awaitable(wait)
+
+
+def until(function, timeout=0):
+    def wait():
+        deadline = _world.get().now_us + timeout * 1000 if timeout else None
+        return ("until", function, deadline)
+    return _Awaitable(wait)
+
+
+def gather(*coroutines):
+    return _Gather(coroutines)
@@ -0,0 +1,35 @@
+# Stand-in for the MicroPython time module, backed by the virtual clock
+
+from sim import world as _world
+
+
+def ticks_ms():
+    return _world.get().now_us // 1000
+
+
+def ticks_us():
+    return _world.get().now_us
+
+
+def ticks_add(ticks, delta):
+    return ticks + delta
+
+
+def ticks_diff(ticks1, ticks2):
+    return ticks1 - ticks2
+
+
+def sleep_ms(ms):
+    _world.get().advance(int(ms) * 1000)
+
+
+def sleep_us(us):
+    _world.get().advance(int(us))
+
+
+def sleep(seconds):
+    _world.get().advance(int(seconds * 1000000))
+
+
+def time():
+    return _world.get().now_us // 1000000
@@ -0,0 +1,197 @@
+# Offline gain tuning against the simulator
+#
+# Runs follow_gyro_angle and pivot_gyro_turn_abs from princess.py, as
+# written, on a simulated drivetrain with a late gyro and a slipping
+# wheel, for every point of a grid of gains/speeds. Candidates are
+# evaluated in parallel on a process pool. Prints the Pareto front of
+# segment time vs final error and the constants to paste into princess.py.
+#
+#   python -m sim.tune drive                   # DRIVE_GAINS_FORWARD/REVERSE
+#   python -m sim.tune turn --speed 200 300 400
+#   python -m sim.tune drive --kp 1 1.5 2 --kd 0 0.1 --jobs 4
+
+import argparse
+import concurrent.futures
+import itertools
+import math
+import os
+
+from sim import World, load_program, run
+from sim import world as _world
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# drive test: drive DRIVE_DISTANCE cm holding a heading HEADING_STEP
+# degrees off the start heading, so the controller has to turn onto it
+DRIVE_DISTANCE = 60
+HEADING_STEP = 5
+
+# turn test: pivot in place from 0 to TURN_ANGLE degrees
+TURN_ANGLE = 90
+
+# program loaded once per worker process
+_program = None
+
+
+def _init_worker(path):
+    global _program
+    _program = load_program(path, World(), autorun=False)
+    _program.LOG_SAMPLES = False
+    _program.PRINT_LOOP_STATS = False
+
+
+def _new_world(disturbance):
+    # fresh world with the drive pair set up and the program's trackers at 0
+    world = _world.use(World())
+    world.yaw_delay_us = int(disturbance["yaw_delay_ms"] * 1000)
+    world.traction[_program.port.A] = disturbance["left_traction"]
+    _program.motor_pair.pair(_program.motor_pair.PAIR_1, _program.port.A, _program.port.E)
+    _program.motion_sensor.reset_yaw(0)
+    _program.heading_tracker.reset()
+    _program.pose.reset()
+    return world
+
+
+def evaluate_drive(candidate, disturbance):
+    # (time_s, heading_error, position_error) for one drive candidate
+    speed, kp, ki, kd = candidate
+    world = _new_world(disturbance)
+    direction = 1 if speed > 0 else -1
+    degrees = _program.degrees_for_distance(DRIVE_DISTANCE)
+    # gains are magnitudes like the schedule, sign them for the direction
+    sign = -direction
+    start_us = world.now_us
+    run(_program.follow_gyro_angle(speed=speed, target_angle=HEADING_STEP,
+                                   until=_program.Travel(direction * degrees, direction),
+                                   kp=sign * kp, ki=sign * ki, kd=sign * kd, profile_distance=degrees), world)
+    heading_error = abs(_world.wrap_angle(world.heading - HEADING_STEP))
+    # distance off the line the robot would have driven had it turned
+    # onto the heading at the start
+    radians = math.radians(HEADING_STEP)
+    position_error = abs(world.y * math.cos(radians) - world.x * math.sin(radians))
+    return (world.now_us - start_us) / 1000000.0, heading_error, position_error
+
+
+def evaluate_turn(candidate, disturbance):
+    # (time_s, heading_error, position_error) for one pivot candidate
+    speed, slow_angle, min_speed, brake_deceleration = candidate
+    _program.TURN_SLOW_ANGLE = slow_angle
+    _program.TURN_MIN_SPEED = min_speed
+    _program.TURN_BRAKE_DECELERATION = brake_deceleration
+    world = _new_world(disturbance)
+    start_us = world.now_us
+    run(_program.pivot_gyro_turn_abs(left_speed=speed, right_speed=-speed, angle=TURN_ANGLE, stop=True), world)
+    heading_error = abs(_world.wrap_angle(world.heading - TURN_ANGLE))
+    return (world.now_us - start_us) / 1000000.0, heading_error, math.hypot(world.x, world.y)
+
+
+def _evaluate(task):
+    kind, candidate, disturbance = task
+    evaluate = evaluate_drive if kind == "drive" else evaluate_turn
+    return candidate, evaluate(candidate, disturbance)
+
+
+def evaluate_all(kind, candidates, disturbance, program, jobs=None):
+    # [(candidate, (time_s, heading_error, position_error))] in candidate order
+    tasks = [(kind, candidate, disturbance) for candidate in candidates]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                                initargs=(program,)) as pool:
+        return list(pool.map(_evaluate, tasks, chunksize=max(1, len(tasks) // (4 * (jobs or os.cpu_count() or 1)))))
+
+
+def error_of(result):
+    # one number to rank by: heading degrees and position cm count the same
+    return result[1][1] + result[1][2]
+
+
+def pareto_front(results):
+    # results no other result beats on both time and error, fastest first
+    front = []
+    best_error = None
+    for result in sorted(results, key=lambda r: (r[1][0], error_of(r))):
+        if best_error is None or error_of(result) < best_error:
+            front.append(result)
+            best_error = error_of(result)
+    return front
+
+
+def print_front(names, front):
+    print("pareto front (time vs heading + position error):")
+    print("  " + "  ".join("{:>8}".format(name) for name in names) + "    time_s  heading  position")
+    for candidate, (time_s, heading_error, position_error) in front:
+        print("  " + "  ".join("{:8g}".format(value) for value in candidate)
+              + "  {:8.3f}  {:7.2f}  {:8.2f}".format(time_s, heading_error, position_error))
+
+
+def print_schedule(results):
+    # best gains per speed, as gain schedule rows for princess.py
+    for name, forward in (("DRIVE_GAINS_FORWARD", True), ("DRIVE_GAINS_REVERSE", False)):
+        best = {}
+        for result in results:
+            speed = result[0][0]
+            if (speed > 0) != forward:
+                continue
+            if abs(speed) not in best or error_of(result) < error_of(best[abs(speed)]):
+                best[abs(speed)] = result
+        if not best:
+            continue
+        print(name + " = (")
+        for speed in sorted(best):
+            _, kp, ki, kd = best[speed][0]
+            print("    ({}, {:g}, {:g}, {:g}),".format(speed, kp, ki, kd))
+        print(")")
+
+
+def print_turn_constants(front, tolerance):
+    # fastest candidate that still lands within tolerance
+    for (speed, slow_angle, min_speed, brake_deceleration), (time_s, heading_error, _) in front:
+        if heading_error <= tolerance:
+            print("# pivot speed {} turns {} degrees in {:.3f} s".format(speed, TURN_ANGLE, time_s))
+            print("TURN_SLOW_ANGLE = {:g}".format(slow_angle))
+            print("TURN_MIN_SPEED = {:g}".format(min_speed))
+            print("TURN_BRAKE_DECELERATION = {:g}".format(brake_deceleration))
+            return
+    print("# no candidate landed within {} degrees".format(tolerance))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim.tune", description="Tune drive gains or pivot turns.")
+    parser.add_argument("kind", choices=("drive", "turn"))
+    parser.add_argument("--program", default=os.path.join(ROOT, "princess.py"))
+    parser.add_argument("--jobs", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--yaw-delay-ms", type=float, default=20, help="how late the simulated gyro reports")
+    parser.add_argument("--left-traction", type=float, default=0.97,
+                        help="fraction of left wheel travel that reaches the mat")
+    parser.add_argument("--speed", type=int, nargs="+",
+                        help="drive velocities (negative for reverse) or pivot wheel speeds")
+    parser.add_argument("--kp", type=float, nargs="+", default=[0.5, 0.8, 1.1, 1.45, 1.8, 2.2, 2.6, 3.0])
+    parser.add_argument("--ki", type=float, nargs="+", default=[0, 0.005, 0.01, 0.02])
+    parser.add_argument("--kd", type=float, nargs="+", default=[0, 0.05, 0.1, 0.2, 0.4])
+    parser.add_argument("--slow-angle", type=float, nargs="+", default=[10, 20, 30])
+    parser.add_argument("--min-speed", type=int, nargs="+", default=[50, 80, 120])
+    parser.add_argument("--brake-deceleration", type=int, nargs="+", default=[2000, 3000, 5000])
+    args = parser.parse_args(argv)
+
+    disturbance = {"yaw_delay_ms": args.yaw_delay_ms, "left_traction": args.left_traction}
+    if args.kind == "drive":
+        speeds = args.speed or [200, 400, 600, 800, 1100, -200, -400, -600, -800, -1100]
+        names = ("speed", "kp", "ki", "kd")
+        candidates = list(itertools.product(speeds, args.kp, args.ki, args.kd))
+    else:
+        speeds = args.speed or [200, 300, 400, 500]
+        names = ("speed", "slow", "min", "brake")
+        candidates = list(itertools.product(speeds, args.slow_angle, args.min_speed, args.brake_deceleration))
+
+    print("evaluating {} {} candidates".format(len(candidates), args.kind))
+    results = evaluate_all(args.kind, candidates, disturbance, args.program, args.jobs)
+    print_front(names, pareto_front(results))
+    print()
+    if args.kind == "drive":
+        print_schedule(results)
+    else:
+        tolerance = load_program(args.program, World(), autorun=False).TURN_TOLERANCE
+        print_turn_constants(pareto_front(results), tolerance)
+
+
+if __name__ == "__main__":
+    main()
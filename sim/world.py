@@ -0,0 +1,360 @@
+# Simulated robot and field shared by the SPIKE stand-in modules
+#
+# The world owns a virtual clock (microseconds), one motor model per hub
+# port and a kinematic differential-drive model for the paired drive
+# motors. Every hardware call made by a program costs a little virtual
+# time, so busy loops on the hub still advance the clock here.
+
+import collections
+import math
+import random
+
+
+# CONSTANTS
+#----------------------------------------
+
+# keep in sync with WHEEL_CIRCUMFERENCE in princess.py
+WHEEL_CIRCUMFERENCE = 17.584
+
+# distance between the two drive wheel contact points in cm
+TRACK_WIDTH = 11.2
+
+# fastest speed a motor will turn in deg/s, and the battery voltage in mV
+# down to which a loaded motor still gets there (slower in proportion
+# below it); faster commands saturate
+MAX_SPEED = 1100
+FULL_SPEED_MV = 7200
+
+# battery voltage of a charged hub in mV
+FULL_BATTERY_MV = 8300
+
+# default motor acceleration/deceleration in deg/s^2 (SPIKE default)
+DEFAULT_ACCELERATION = 1000
+
+# how hard motors decelerate on stop(BRAKE/HOLD) and stop(COAST)
+BRAKE_DECELERATION = 10000
+COAST_DECELERATION = 1500
+
+# field lines seen by the color sensors: reflection (percent) on the mat
+# and on a line, line width and the radius of a sensor's light spot in cm
+WHITE_REFLECTION = 95
+BLACK_REFLECTION = 12
+LINE_WIDTH = 1.5
+SENSOR_SPOT = 0.8
+
+# virtual time charged for each hardware call
+CALL_COST_US = 250
+
+# physics integration step
+STEP_US = 1000
+
+# hub ports (same values as hub.port)
+PORTS = (0, 1, 2, 3, 4, 5)
+
+# stop modes (same values as motor.COAST/BRAKE/HOLD)
+COAST = 0
+BRAKE = 1
+HOLD = 2
+
+# END CONSTANTS
+#----------------------------------------
+
+
+class SimulationTimeout(Exception):
+    pass
+
+
+def wrap_angle(angle):
+    # wrap an angle in degrees into [-180, 180)
+    return (angle + 180.0) % 360.0 - 180.0
+
+
+def _segment_distance(x, y, line):
+    # distance from (x, y) to a line segment
+    (x1, y1), (x2, y2) = line
+    dx, dy = x2 - x1, y2 - y1
+    length = dx * dx + dy * dy
+    t = 0.0 if length == 0 else max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / length))
+    return math.hypot(x - x1 - t * dx, y - y1 - t * dy)
+
+
+class Motor:
+
+    def __init__(self):
+        self.position = 0.0
+        self.velocity = 0.0
+        self.offset = 0.0
+        self.target_velocity = 0.0
+        self.acceleration = DEFAULT_ACCELERATION
+        self.deceleration = DEFAULT_ACCELERATION
+        # position goal for run_for_degrees style commands
+        self.goal = None
+        self.cruise = 0.0
+        # bumped on every new command so older awaitables complete
+        self.command = 0
+        self.busy = False
+        # time constant (s) of the motor following its speed target on top
+        # of the acceleration limit, 0 to follow it right away
+        self.response_s = 0.0
+        # held by something (a model, a wall): the motor doesn't turn
+        self.jammed = False
+
+    def new_command(self):
+        self.command += 1
+        self.goal = None
+        self.busy = True
+        return self.command
+
+    def run(self, velocity, acceleration=DEFAULT_ACCELERATION):
+        command = self.new_command()
+        self.target_velocity = max(-MAX_SPEED, min(MAX_SPEED, velocity))
+        self.acceleration = acceleration
+        self.deceleration = acceleration
+        return command
+
+    def run_for_degrees(self, degrees, velocity,
+                        acceleration=DEFAULT_ACCELERATION,
+                        deceleration=DEFAULT_ACCELERATION):
+        command = self.new_command()
+        direction = 1 if (degrees >= 0) == (velocity >= 0) else -1
+        self.goal = self.position + direction * abs(degrees)
+        self.cruise = min(abs(velocity), MAX_SPEED)
+        self.acceleration = acceleration
+        self.deceleration = deceleration
+        return command
+
+    def stop(self, stop=BRAKE):
+        command = self.new_command()
+        self.busy = False
+        self.target_velocity = 0.0
+        self.deceleration = COAST_DECELERATION if stop == COAST else BRAKE_DECELERATION
+        return command
+
+    def relative_position(self):
+        return int(round(self.position - self.offset))
+
+    def reset_relative_position(self, position):
+        self.offset = self.position - position
+
+    def integrate(self, dt, max_speed=MAX_SPEED):
+        if self.jammed:
+            self.velocity = 0.0
+            return
+        if self.goal is not None:
+            remaining = self.goal - self.position
+            if abs(remaining) <= max(abs(self.velocity) * dt, 0.5):
+                self.position = self.goal
+                self.velocity = 0.0
+                self.target_velocity = 0.0
+                self.goal = None
+                self.busy = False
+                return
+            braking_speed = math.sqrt(2.0 * self.deceleration * abs(remaining))
+            desired = math.copysign(min(self.cruise, braking_speed), remaining)
+        else:
+            desired = self.target_velocity
+        desired = max(-max_speed, min(max_speed, desired))
+
+        change = desired - self.velocity
+        if self.response_s:
+            change *= min(1.0, dt / self.response_s)
+        speeding_up = abs(desired) > abs(self.velocity) and desired * self.velocity >= 0
+        limit = (self.acceleration if speeding_up else self.deceleration) * dt
+        if change > limit:
+            change = limit
+        elif change < -limit:
+            change = -limit
+        self.velocity += change
+        self.position += self.velocity * dt
+
+
+class World:
+
+    def __init__(self, time_limit_s=900, transition_ms=0):
+        self.now_us = 0
+        self.time_limit_us = int(time_limit_s * 1000000)
+        self.transition_ms = transition_ms
+        self.motors = {p: Motor() for p in PORTS}
+        # drive pair: (left port, right port); the left motor is mounted
+        # mirrored so its encoder counts down when driving forward
+        self.drive = None
+        self.mirror = {p: 1 for p in PORTS}
+        # robot pose: x/y in cm, heading in degrees (clockwise positive)
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.yaw_zero = 0.0
+        self.press_at_us = None
+        self.calls = 0
+        # sensor reads and runloop sleeps, for benchmarks
+        self.reads = 0
+        self.sleeps = 0
+        # drivetrain imperfections, off by default: the fraction of each
+        # motor's wheel travel that reaches the mat (slip), how late the
+        # gyro reports the heading, gyro noise (standard deviation in
+        # degrees per read) and drift (deg/s), and how far off (standard
+        # deviation of x/y in cm and heading in degrees) the operator
+        # places the robot in base
+        self.traction = {p: 1.0 for p in PORTS}
+        # more slip the faster a wheel turns: traction drops by this
+        # fraction per 1000 deg/s of wheel speed
+        self.slip_per_speed = 0.0
+        self.yaw_delay_us = 0
+        self.heading_history = collections.deque(maxlen=1000)
+        self.yaw_noise = 0.0
+        self.yaw_drift = 0.0
+        self.placement_error = (0.0, 0.0, 0.0)
+        self.random = random.Random(0)
+        # black lines on the mat, ((x1, y1), (x2, y2)) in cm, and where each
+        # color sensor sits on the robot, port: (forward_cm, right_cm);
+        # sensors without a position read a flat 50
+        self.lines = []
+        self.sensor_offsets = {}
+        # hub battery voltage in mV, caps how fast the motors turn
+        self.battery_mv = FULL_BATTERY_MV
+
+    # CLOCK
+    #----------------------------------------
+
+    def advance(self, us):
+        end = self.now_us + int(us)
+        if end > self.time_limit_us:
+            raise SimulationTimeout("simulated time limit of {} s reached".format(self.time_limit_us // 1000000))
+        while self.now_us < end:
+            step = min(STEP_US, end - self.now_us)
+            self.integrate(step / 1000000.0)
+            self.now_us += step
+            if self.yaw_delay_us:
+                self.heading_history.append((self.now_us, self.heading))
+
+    def charge(self):
+        # time spent by the hub servicing one hardware call
+        self.calls += 1
+        self.advance(CALL_COST_US)
+
+    def read(self):
+        # a hardware call that reads a sensor or encoder
+        self.reads += 1
+        self.charge()
+
+    def ticks_ms(self):
+        return self.now_us // 1000
+
+    # ROBOT
+    #----------------------------------------
+
+    def pair(self, left_port, right_port):
+        self.drive = (left_port, right_port)
+        self.mirror[left_port] = -1
+        self.mirror[right_port] = 1
+
+    def wheel(self, port):
+        # forward wheel travel in degrees for a drive motor
+        return self.mirror[port] * self.motors[port].position
+
+    def place_robot(self):
+        # operator puts the robot back in base
+        x_error, y_error, heading_error = self.placement_error
+        self.x = self.random.gauss(0.0, x_error) if x_error else 0.0
+        self.y = self.random.gauss(0.0, y_error) if y_error else 0.0
+        self.heading = self.random.gauss(0.0, heading_error) if heading_error else 0.0
+        for motor in self.motors.values():
+            motor.velocity = 0.0
+            motor.target_velocity = 0.0
+            motor.goal = None
+            motor.busy = False
+
+    def max_speed(self):
+        # fastest a motor turns on the battery
+        return min(MAX_SPEED, MAX_SPEED * self.battery_mv / FULL_SPEED_MV)
+
+    def grip(self, port, before, dt):
+        # share of the wheel's travel since before that reaches the mat
+        if not self.slip_per_speed or dt <= 0:
+            return self.traction[port]
+        speed = abs(self.wheel(port) - before) / dt
+        return self.traction[port] * (1.0 - self.slip_per_speed * speed / 1000.0)
+
+    def integrate(self, dt):
+        max_speed = self.max_speed()
+        if self.drive is None:
+            for motor in self.motors.values():
+                motor.integrate(dt, max_speed)
+            return
+
+        left_port, right_port = self.drive
+        left_before = self.wheel(left_port)
+        right_before = self.wheel(right_port)
+        for motor in self.motors.values():
+            motor.integrate(dt, max_speed)
+        left = (self.wheel(left_port) - left_before) * self.grip(left_port, left_before, dt) * WHEEL_CIRCUMFERENCE / 360.0
+        right = (self.wheel(right_port) - right_before) * self.grip(right_port, right_before, dt) * WHEEL_CIRCUMFERENCE / 360.0
+
+        distance = (left + right) / 2.0
+        turn = math.degrees((left - right) / TRACK_WIDTH)
+        middle = math.radians(self.heading + turn / 2.0)
+        self.x += distance * math.cos(middle)
+        self.y += distance * math.sin(middle)
+        self.heading += turn
+
+    # SENSORS
+    #----------------------------------------
+
+    def yaw(self):
+        # yaw in degrees as reported by the hub (clockwise positive)
+        heading = self.heading
+        if self.yaw_delay_us:
+            seen_us = self.now_us - self.yaw_delay_us
+            for time_us, past in reversed(self.heading_history):
+                heading = past
+                if time_us <= seen_us:
+                    break
+        if self.yaw_drift:
+            heading += self.yaw_drift * self.now_us / 1000000.0
+        if self.yaw_noise:
+            heading += self.random.gauss(0.0, self.yaw_noise)
+        return wrap_angle(heading - self.yaw_zero)
+
+    def reset_yaw(self, angle=0):
+        self.yaw_zero = self.heading + self.yaw_drift * self.now_us / 1000000.0 - angle
+
+    def reflection(self, port):
+        offset = self.sensor_offsets.get(port)
+        if offset is None:
+            return 50
+        radians = math.radians(self.heading)
+        x = self.x + offset[0] * math.cos(radians) - offset[1] * math.sin(radians)
+        y = self.y + offset[0] * math.sin(radians) + offset[1] * math.cos(radians)
+        distance = min((_segment_distance(x, y, line) for line in self.lines), default=float("inf"))
+        # share of the light spot on the line
+        dark = (LINE_WIDTH / 2 + SENSOR_SPOT - distance) / (2 * SENSOR_SPOT)
+        dark = max(0.0, min(1.0, dark))
+        return int(round(WHITE_REFLECTION + dark * (BLACK_REFLECTION - WHITE_REFLECTION)))
+
+    def button_pressed(self, left):
+        # the operator presses LEFT once the robot is placed in base
+        if not left:
+            return 0
+        if self.press_at_us is None:
+            self.press_at_us = self.now_us + self.transition_ms * 1000
+        if self.now_us < self.press_at_us:
+            return 0
+        self.press_at_us = None
+        self.place_robot()
+        return 100
+
+
+# world used by the stand-in modules
+current = None
+
+
+def use(world):
+    global current
+    current = world
+    return world
+
+
+def get():
+    if current is None:
+        use(World())
+    return current
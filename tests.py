@@ -2,41 +2,150 @@
 import color, color_sensor, device, motor, motor_pair, orientation, runloop
 import hub
 import sys
+import time
 
 from hub import light_matrix, button, motion_sensor, light, sound, port
 # START Common Functions--------------------------------------------------------------------------------------------
 WHEEL_CIRCUMFERENCE = 17.584
 
+# how often drive/turn control loops run and yield to other coroutines
+CONTROL_FREQUENCY_HZ = 100
+CONTROL_PERIOD_MS = 1000 // CONTROL_FREQUENCY_HZ
+
+# print loop period stats at the end of every drive segment
+PRINT_LOOP_STATS = False
+
+# gyro drive gain schedule per direction, (velocity, kp, ki, kd) rows
+# interpolated on the commanded velocity, same as princess.py. It replaces
+# the gains the tests used to pass by hand (kp 1.25, ki 0.002, kd 0.001 at
+# 1000; kp 0.9, kd 0.1 on the pit drive), which were never measured
+# against 1.45 and don't hold the heading any better in the simulator
+DRIVE_GAINS_FORWARD = (
+    (200, 1.45, 0, 0),
+    (1100, 1.45, 0, 0),
+)
+DRIVE_GAINS_REVERSE = (
+    (200, 1.45, 0, 0),
+    (1100, 1.45, 0, 0),
+)
+
+# wait up to GYRO_STABLE_TIMEOUT_MS for the hub to be still after a yaw reset
+GYRO_STABLE_TIMEOUT_MS = 1000
+GYRO_SAMPLE_MS = 10
+
+# how often wait_for_yaw_abs reads the yaw
+YAW_POLL_MS = 5
+
 WHITE_COLOR_INTENSITY_MIN = 97
 BLACK_COLOR_INTENSITY_MAX = 18
 
 COLOR_SENSOR_CENTER_PORT = port.C
 COLOR_SENSOR_LEFT_PORT = port.D
 
-def follow_for_distance(initial_position=0,
-                        distance_to_cover=0):
-    current_position = abs(motor.relative_position(port.A))
-    distance_covered = current_position - initial_position
-    if distance_covered < 0 : distance_covered = distance_covered * -1
-    if (distance_covered >= abs(distance_to_cover)):
+# longest a drive may run before it gives up on its stop condition
+DRIVE_TIMEOUT_MS = 10000
+
+# Stop conditions, built once per drive and combined with Any; the drive
+# fills one Snapshot per tick (yaw, port A encoder, time and only the
+# color sensors the conditions use), same as princess.py
+class Snapshot:
+
+    def __init__(self, ports=()):
+        self.ports = ports
+        self.reflection = {}
+        self.heading = 0.0
+        self.travel = 0
+        self.now_ms = 0
+
+    def update(self):
+        self.heading = get_yaw_value()
+        self.travel = motor.relative_position(port.A)
+        self.now_ms = time.ticks_ms()
+        for sensor_port in self.ports:
+            self.reflection[sensor_port] = color_sensor.reflection(sensor_port)
+
+class Condition:
+    ports = ()
+
+    def start(self, snapshot):
+        pass
+
+    def met(self, snapshot):
         return False
-    else:
-        return True
 
-def get_color_values():
-    return color_sensor.reflection(COLOR_SENSOR_CENTER_PORT), color_sensor.reflection(COLOR_SENSOR_LEFT_PORT)
+# covered degrees on port A, either way, since the drive started
+class Distance(Condition):
+
+    def __init__(self, degrees):
+        self.degrees = degrees
+        self.start_travel = 0
+
+    def start(self, snapshot):
+        self.start_travel = snapshot.travel
+
+    def met(self, snapshot):
+        return abs(snapshot.travel - self.start_travel) >= self.degrees
+
+# reflection on the color sensor at sensor_port below or above a threshold
+class Reflection(Condition):
 
-def follow_for_color_white_center():
-    return get_color_values()[0] <= WHITE_COLOR_INTENSITY_MIN
+    def __init__(self, sensor_port, below=None, above=None):
+        self.ports = (sensor_port,)
+        self.sensor_port = sensor_port
+        self.below = below
+        self.above = above
 
-def follow_for_color_black_center():
-    return get_color_values()[0] >= BLACK_COLOR_INTENSITY_MAX
+    def met(self, snapshot):
+        value = snapshot.reflection[self.sensor_port]
+        return ((self.below is not None and value < self.below)
+                or (self.above is not None and value > self.above))
 
-def follow_for_color_white_left():
-    return get_color_values()[1] <= WHITE_COLOR_INTENSITY_MIN
+class Elapsed(Condition):
 
-def follow_for_color_black_left():
-    return get_color_values()[1] >= BLACK_COLOR_INTENSITY_MAX
+    def __init__(self, ms):
+        self.ms = ms
+        self.start_ms = 0
+
+    def start(self, snapshot):
+        self.start_ms = snapshot.now_ms
+
+    def met(self, snapshot):
+        return time.ticks_diff(snapshot.now_ms, self.start_ms) >= self.ms
+
+class Any(Condition):
+
+    def __init__(self, *conditions):
+        self.conditions = conditions
+        ports = []
+        for condition in conditions:
+            for sensor_port in condition.ports:
+                if sensor_port not in ports:
+                    ports.append(sensor_port)
+        self.ports = tuple(ports)
+
+    def start(self, snapshot):
+        for condition in self.conditions:
+            condition.start(snapshot)
+
+    def met(self, snapshot):
+        for condition in self.conditions:
+            if condition.met(snapshot):
+                return True
+        return False
+
+WHITE_CENTER = Reflection(COLOR_SENSOR_CENTER_PORT, above=WHITE_COLOR_INTENSITY_MIN)
+BLACK_CENTER = Reflection(COLOR_SENSOR_CENTER_PORT, below=BLACK_COLOR_INTENSITY_MAX)
+WHITE_LEFT = Reflection(COLOR_SENSOR_LEFT_PORT, above=WHITE_COLOR_INTENSITY_MIN)
+BLACK_LEFT = Reflection(COLOR_SENSOR_LEFT_PORT, below=BLACK_COLOR_INTENSITY_MAX)
+
+# wait until the hub reports it is still, at most GYRO_STABLE_TIMEOUT_MS
+async def wait_for_stable():
+    start = time.ticks_ms()
+    while not motion_sensor.stable():
+        if time.ticks_diff(time.ticks_ms(), start) >= GYRO_STABLE_TIMEOUT_MS:
+            return False
+        await runloop.sleep_ms(GYRO_SAMPLE_MS)
+    return True
 
 def get_yaw_value():
     return motion_sensor.tilt_angles()[0] * -0.1
@@ -45,53 +154,172 @@ def degreesForDistance(distance_cm):
     # Add multiplier for gear ratio if needed
     return int((distance_cm/WHEEL_CIRCUMFERENCE) * 360)
 
-def wait_for_yaw_abs(angle=0):
-    abs_angle = abs(angle)
-    abs_current_yaw = abs(get_yaw_value())
-    if angle == 0:
-        if get_yaw_value() > 0:
-            while get_yaw_value() >= angle: runloop.sleep_ms(10)
-        elif get_yaw_value() < 0:
-            while get_yaw_value() <= angle: runloop.sleep_ms(10)
-    elif abs_current_yaw > abs_angle:
-        while abs(get_yaw_value()) >= abs_angle: runloop.sleep_ms(10)
-    elif abs_current_yaw < abs_angle:
-        while abs(get_yaw_value()) <= abs_angle: runloop.sleep_ms(10)
-
-async def follow_gyro_angle(kp,
-                            ki,
-                            kd,
-                            speed,
+def wrap_angle(angle):
+    # wrap an angle in degrees into [-180, 180)
+    return (angle + 180) % 360 - 180
+
+
+def turn_remaining(angle, yaw, direction):
+    # degrees still to turn in direction (1 right, -1 left), negative once past
+    # the target; turns of up to 330 degrees are told apart from overshoot
+    remaining = ((angle - yaw) * direction) % 360
+    return remaining - 360 if remaining > 330 else remaining
+
+
+# Wait until the yaw reaches angle turning in direction (1 right, -1
+# left, 0 the shorter way from here). Reads the sensor once per tick
+# every poll_ms, and once the yaw rate says the target is less than a
+# tick away, sleeps just until the predicted crossing instead.
+async def wait_for_yaw_abs(angle=0, direction=0, poll_ms=YAW_POLL_MS):
+    yaw = get_yaw_value()
+    if direction == 0:
+        direction = 1 if wrap_angle(angle - yaw) >= 0 else -1
+    last_yaw = yaw
+    last_us = time.ticks_us()
+    rate = 0.0
+    # count down from the start so an overshoot reads negative, however large
+    remaining = turn_remaining(angle, yaw, direction)
+    while True:
+        if remaining <= 0:
+            return
+        if rate > 0:
+            eta_ms = remaining * 1000 / rate
+            if eta_ms < poll_ms:
+                await runloop.sleep_ms(int(eta_ms))
+                return
+        await runloop.sleep_ms(poll_ms)
+        yaw = get_yaw_value()
+        now = time.ticks_us()
+        elapsed_us = time.ticks_diff(now, last_us)
+        # yaw rate in deg/s in the turn direction
+        turned = wrap_angle(yaw - last_yaw) * direction
+        remaining -= turned
+        rate = turned * 1000000 / elapsed_us if elapsed_us > 0 else 0
+        last_yaw = yaw
+        last_us = now
+
+
+# Fixed-rate control loop timer. Await tick() once per iteration: it
+# sleeps until the next period boundary and returns the measured time
+# since the previous tick in units of the nominal period (1.0 when on
+# time), so I and D terms keep the same meaning at any loop rate.
+# Also records min/mean/max loop period and jitter for the segment.
+class ControlLoop:
+
+    def __init__(self, frequency_hz=CONTROL_FREQUENCY_HZ):
+        self.period_us = 1000000 // frequency_hz
+        self.count = 0
+        self.min_us = 0
+        self.max_us = 0
+        self.total_us = 0
+        self.total_sq_us = 0.0
+        self.last_tick = time.ticks_us()
+        self.next_tick = time.ticks_add(self.last_tick, self.period_us)
+
+    async def tick(self):
+        wait_ms = time.ticks_diff(self.next_tick, time.ticks_us()) // 1000
+        await runloop.sleep_ms(wait_ms if wait_ms > 0 else 0)
+        now = time.ticks_us()
+        dt_us = time.ticks_diff(now, self.last_tick)
+        self.last_tick = now
+        # fell behind (slow stop conditions, prints): restart the schedule from now
+        self.next_tick = time.ticks_add(self.next_tick, self.period_us)
+        if time.ticks_diff(self.next_tick, now) <= 0:
+            self.next_tick = time.ticks_add(now, self.period_us)
+
+        if self.count == 0 or dt_us < self.min_us: self.min_us = dt_us
+        if dt_us > self.max_us: self.max_us = dt_us
+        self.count += 1
+        self.total_us += dt_us
+        self.total_sq_us += dt_us * dt_us
+        return dt_us / self.period_us if dt_us > 0 else 1.0
+
+    def mean_us(self):
+        return self.total_us / self.count if self.count else 0
+
+    def jitter_us(self):
+        # standard deviation of the loop period
+        if not self.count:
+            return 0
+        variance = self.total_sq_us / self.count - self.mean_us() ** 2
+        return variance ** 0.5 if variance > 0 else 0
+
+    def report(self, label=""):
+        print("{} loops={} period min/mean/max={:.1f}/{:.1f}/{:.1f} ms jitter={:.2f} ms".format(
+            label, self.count, self.min_us / 1000, self.mean_us() / 1000, self.max_us / 1000,
+            self.jitter_us() / 1000))
+
+
+def scheduled_gains(velocity):
+    # (kp, ki, kd) for a commanded velocity from the gain schedule of its
+    # direction, signed -ve for forward and +ve for backward movement
+    table = DRIVE_GAINS_FORWARD if velocity > 0 else DRIVE_GAINS_REVERSE
+    sign = -1 if velocity > 0 else 1
+    speed = abs(velocity)
+    low = table[0]
+    if speed <= low[0]:
+        return sign * low[1], sign * low[2], sign * low[3]
+    for high in table[1:]:
+        if speed <= high[0]:
+            f = (speed - low[0]) / (high[0] - low[0])
+            return (sign * (low[1] + f * (high[1] - low[1])), sign * (low[2] + f * (high[2] - low[2])),
+                    sign * (low[3] + f * (high[3] - low[3])))
+        low = high
+    return sign * low[1], sign * low[2], sign * low[3]
+
+
+async def follow_gyro_angle(speed,
                             target_angle,
-                            sleep_time,
-                            follow_for, **kwargs):
-    # get initial reading from left motor
+                            until,
+                            kp=None,
+                            ki=0,
+                            kd=0,
+                            sleep_time=0,
+                            frequency_hz=CONTROL_FREQUENCY_HZ,
+                            timeout_ms=DRIVE_TIMEOUT_MS):
+    # drive until the stop condition until is met or timeout_ms have passed
+    until = Any(until, Elapsed(timeout_ms))
+    snapshot = Snapshot(until.ports)
+    # sleep_time (ms), when set, overrides the control frequency
+    # kp=None takes kp, ki and kd from the gain schedule for speed
+    if kp is None:
+        kp, ki, kd = scheduled_gains(speed)
+    loop = ControlLoop(1000 // sleep_time if sleep_time else frequency_hz)
     integral = 0.0
     last_error = 0.0
     derivative = 0.0
-    while (follow_for(**kwargs)):
-        current_angle = get_yaw_value()
-        print("Current Angle = " + str(current_angle))
-        error = current_angle - target_angle
-        integral = integral + error
-        derivative = error - last_error
+    # time since the previous tick, in control periods
+    dt = 1.0
+    snapshot.update()
+    until.start(snapshot)
+    while not until.met(snapshot):
+        current_angle = snapshot.heading
+        # the short way round, so a target near 180 doesn't swing the robot
+        error = wrap_angle(current_angle - target_angle)
+        integral = integral + error * dt
+        derivative = (error - last_error) / dt
         last_error = error
         # compute steering correction
         steering_value = (error * kp) + (integral * ki) + (derivative * kd)
 
-
-        if sleep_time:
-            runloop.sleep_ms(sleep_time)
         # kp value should be +ve for forward movement (positive speed value), and -ve for backward movement (negative speed value)
         motor_pair.move(motor_pair.PAIR_1, int(steering_value), velocity=speed)
 
-    # stop when follow_for condition is met
+        # yield to other coroutines until the next control tick
+        dt = await loop.tick()
+        snapshot.update()
+
+    # stop when the condition is met
     motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
+    if PRINT_LOOP_STATS:
+        loop.report("follow_gyro_angle " + str(target_angle))
+    return loop
 
 async def pivot_gyro_turn_abs(left_speed=0, right_speed=50, angle=90, stop=False):
     motor_pair.move_tank(motor_pair.PAIR_1, left_speed, right_speed)
     # print("pivot_gyro_turn - " + "target angle=" + str(angle) + "current angle ="+ str(get_yaw_value()))
-    wait_for_yaw_abs(angle=angle)
+    # turning right (clockwise) when the left wheel is faster
+    await wait_for_yaw_abs(angle=angle, direction=1 if left_speed > right_speed else -1)
     if stop: motor_pair.stop(motor_pair.PAIR_1, stop=motor.HOLD)
 
 async def turn_left(speed=50, angle=90, stop=True):
@@ -103,11 +331,8 @@ async def turn_right(speed=-50, angle=90, stop=True):
 # END Common Functions--------------------------------------------------------------------------------------------
 
 async def test_follow_gyro_angle_for_distance(distance):
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
     print("degreesForDistance = {}".format(str(degreesForDistance(distance))))
-    await follow_gyro_angle(kp=-1.25*(int(distance/abs(distance))), ki=0.002, kd=-0.001, speed=1000*(int(distance/abs(distance))), target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degreesForDistance(distance)))
+    await follow_gyro_angle(speed=1000*(int(distance/abs(distance))), target_angle=0, until=Distance(degreesForDistance(abs(distance))))
 
 async def test_turn_left(angle=90):
     await turn_left(speed=350, angle=angle, stop=True)
@@ -116,74 +341,52 @@ async def test_turn_right(angle=0):
     await turn_right(speed=350, angle=0, stop=True)
 
 async def test_go_to_black_center(reverse=False):
-    await follow_gyro_angle(kp=-1.45*(1 if reverse else -1), ki=0, kd=0,
-                            speed=250*(-1 if reverse else 1), target_angle=0, sleep_time=0, follow_for=follow_for_color_black_center)
+    await follow_gyro_angle(speed=250*(-1 if reverse else 1), target_angle=0, until=BLACK_CENTER)
 
 async def test_go_to_white_center(reverse=False):
-    await follow_gyro_angle(kp=-1.45*(1 if reverse else -1), ki=0, kd=0,
-                            speed=250*(-1 if reverse else 1), target_angle=0, sleep_time=0, follow_for=follow_for_color_white_center)
+    await follow_gyro_angle(speed=250*(-1 if reverse else 1), target_angle=0, until=WHITE_CENTER)
 
 async def test_go_to_black_left(reverse=False):
-    await follow_gyro_angle(kp=-1.45*(1 if reverse else -1), ki=0, kd=0,
-                            speed=250*(-1 if reverse else 1), target_angle=0, sleep_time=0, follow_for=follow_for_color_black_left)
+    await follow_gyro_angle(speed=250*(-1 if reverse else 1), target_angle=0, until=BLACK_LEFT)
 
 async def test_go_to_white_left(reverse=False):
-    await follow_gyro_angle(kp=-1.45*(1 if reverse else -1), ki=0, kd=0,
-                            speed=250*(-1 if reverse else 1), target_angle=0, sleep_time=0, follow_for=follow_for_color_white_left)
+    await follow_gyro_angle(speed=250*(-1 if reverse else 1), target_angle=0, until=WHITE_LEFT)
 
 async def test_fake_missions():
     # Go forward 20 cm
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
     distance = 20
-    await follow_gyro_angle(kp=-1.45*(int(distance/abs(distance))), ki=0, kd=0, speed=250*(int(distance/abs(distance))), target_angle=0, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degreesForDistance(distance)))
+    await follow_gyro_angle(speed=250*(int(distance/abs(distance))), target_angle=0, until=Distance(degreesForDistance(abs(distance))))
 
     # turn left 45 degrees
     await turn_left(speed=100, angle=45, stop=True)
 
     # go forward 12 cm
     distance = 12
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45*(int(distance/abs(distance))), ki=0, kd=0, speed=250*(int(distance/abs(distance))), target_angle=-45, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degreesForDistance(distance)))
+    await follow_gyro_angle(speed=250*(int(distance/abs(distance))), target_angle=-45, until=Distance(degreesForDistance(abs(distance))))
 
     # go back 12 cm
     distance = -12
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
-    await follow_gyro_angle(kp=-1.45*(int(distance/abs(distance))), ki=0, kd=0, speed=250*(int(distance/abs(distance))), target_angle=-45, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degreesForDistance(distance)))
+    await follow_gyro_angle(speed=250*(int(distance/abs(distance))), target_angle=-45, until=Distance(degreesForDistance(abs(distance))))
 
 
     # Turn right to 45
     await turn_right(speed=150, angle=45, stop=True)
 
     # Go forward 25 cm
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
     distance = 25
-    await follow_gyro_angle(kp=-1.45*(int(distance/abs(distance))), ki=0, kd=0, speed=250*(int(distance/abs(distance))), target_angle=45, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degreesForDistance(distance)))
+    await follow_gyro_angle(speed=250*(int(distance/abs(distance))), target_angle=45, until=Distance(degreesForDistance(abs(distance))))
 
     # Go back 25 cm
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
     distance = -25
-    await follow_gyro_angle(kp=-1.45*(int(distance/abs(distance))), ki=0, kd=0, speed=800*(int(distance/abs(distance))), target_angle=45, sleep_time=0, follow_for=follow_for_distance,
-                    initial_position=initial_position, distance_to_cover=(degreesForDistance(distance)))
+    await follow_gyro_angle(speed=800*(int(distance/abs(distance))), target_angle=45, until=Distance(degreesForDistance(abs(distance))))
 
 
     # Turn right to 180 (facing to the pit)
     await turn_right(speed=150, angle=179, stop=True)
 
     # Go to pit
-    motor.reset_relative_position(port.A, 0)
-    initial_position = abs(motor.relative_position(port.A))
     distance = 20
-    await follow_gyro_angle(kp=-0.9*(int(distance/abs(distance))), ki=0, kd=0.1, speed=650*(int(distance/abs(distance))), target_angle=179, sleep_time=0, follow_for=follow_for_distance,
-                            initial_position=initial_position, distance_to_cover=(degreesForDistance(distance)))
+    await follow_gyro_angle(speed=650*(int(distance/abs(distance))), target_angle=179, until=Distance(degreesForDistance(abs(distance))))
 
 async def mainProgram():
     motor_pair.pair(motor_pair.PAIR_1, port.A, port.E)
@@ -195,7 +398,7 @@ async def mainProgram():
     # reset yaw to 0
     motion_sensor.set_yaw_face(motion_sensor.TOP)
     motion_sensor.reset_yaw(0)
-    await runloop.sleep_ms(1000)
+    await wait_for_stable()
 
     await test_follow_gyro_angle_for_distance(10)
     await test_turn_right()